@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Stage by stage timings and peak memory of the Fabry-Perot and PSF pipelines,
+at reference virtual_steps sizes, saved as json for comparison between runs.
+
+    python benchmarks/run_benchmarks.py --sizes 100000 1000000
+    python benchmarks/run_benchmarks.py --compare results/old.json
+
+@author: User
+"""
+import numpy as np
+import scipy
+import scipy.signal as sci
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(root, 'filter-analysis'))
+sys.path.append(os.path.join(root, 'psf-analysis'))
+import OpticalSystems as opsys
+import psf_cache
+import psf_analyzer as PSF
+import kernel_sweep
+
+reference_sizes = [100000, 1000000, 10000000]
+results_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+#the fabry-perrot-toy setup at virtual_steps = size, everything a stage needs
+#as input is made here, outside of the measurement
+def toy_problem(size):
+    lambda_target = 600e-9
+    lambda_min = lambda_target - 0.3e-9
+    lambda_max = lambda_target + 0.3e-9
+    whitelight = opsys.white_light_generator(lambda_min, lambda_max, size)
+    fabry_perot = opsys.fabry_perot_transmitance(whitelight, 7.6e-3)
+    gauss, _ = opsys.gaussian(0.001, 130000, lambda_target, lambda_max, lambda_min, size)
+    convolution = opsys.kernel_convolution(gauss, fabry_perot)
+    resolution = lambda_target/130000/3
+    pixels, edges = opsys.discretize(whitelight, convolution, resolution, lambda_max, lambda_min)
+    peaks = sci.find_peaks(pixels)[0]
+    valleys = sci.find_peaks(-pixels)[0]
+    means, stds = opsys.batch_gauss_model(peaks, valleys, pixels, edges, vtol = 0.05, show = False)
+    return {'size': size, 'lambda_target': lambda_target, 'lambda_min': lambda_min, 'lambda_max': lambda_max,\
+            'increment': (lambda_max - lambda_min)/size, 'whitelight': whitelight, 'fabry_perot': fabry_perot,\
+            'gauss': gauss, 'convolution': convolution, 'resolution': resolution, 'pixels': pixels, 'edges': edges,\
+            'peaks': peaks, 'valleys': valleys, 'means': means, 'stds': stds}
+
+def _gaussian(p):
+    #the kernels are memoised, a repeat would only measure the cache
+    opsys.gaussian_kernel.cache_clear()
+    return opsys.gaussian(0.001, 130000, p['lambda_target'], p['lambda_max'], p['lambda_min'], p['size'])
+
+def _kernel_compare(p):
+    parameters = dict(kernel_sweep.default_parameters, virtual_steps = p['size'])
+    return kernel_sweep.config_misalignment(p['psf_dataset'][0], parameters)
+
+def _psf_text_parse(p):
+    with tempfile.TemporaryDirectory() as folder:
+        return psf_cache.build_psf_cache(psf_cache.zemax_folder, folder)
+
+def _psf_load(p):
+    return PSF.PSFDataset().ordered_data
+
+#(name, function of the problem, runs at every size)
+stages = [('fabry_perot_transmitance', lambda p: opsys.fabry_perot_transmitance(p['whitelight'], 7.6e-3), True),
+          ('accurate_filter_transmitance', lambda p: opsys.accurate_filter_transmitance(p['whitelight'], 2e-3, \
+              path_length = 43.718e-3, semi_diameter = 0.993e-3, n = 1.5, R1 = 0.63947, tilt_deg = 2), True),
+          ('gaussian', _gaussian, True),
+          ('kernel_convolution', lambda p: opsys.kernel_convolution(p['gauss'], p['fabry_perot']), True),
+          ('discretize', lambda p: opsys.discretize(p['whitelight'], p['convolution'], p['resolution'], \
+                                                    p['lambda_max'], p['lambda_min']), True),
+          ('gauss_model', lambda p: opsys.gauss_model(p['peaks'], p['valleys'], p['pixels'], p['edges'], None, \
+                                                      vtol = 0.05, show = False), True),
+          ('batch_gauss_model', lambda p: opsys.batch_gauss_model(p['peaks'], p['valleys'], p['pixels'], p['edges'], \
+                                                                  vtol = 0.05, show = False), True),
+          ('erf_model', lambda p: opsys.erf_model(p['peaks'], p['valleys'], p['pixels'], p['edges'], p['means'], \
+                                                  p['stds'], p['increment'], vtol = 0.3, show = False), True),
+          ('batch_erf_model', lambda p: opsys.batch_erf_model(p['peaks'], p['valleys'], p['pixels'], p['edges'], \
+                                                              p['means'], p['stds'], p['increment'], vtol = 0.3, \
+                                                              show = False), True),
+          ('kernel_compare_config', _kernel_compare, True),
+          ('psf_text_parse', _psf_text_parse, False),
+          ('psf_load', _psf_load, False)]
+
+#best of repeat wall times(a stage slower than slow seconds is run only once),
+#then one more run under tracemalloc for the peak of the python/numpy allocations
+def measure(function, problem, repeat = 3, slow = 5):
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(problem)
+        seconds.append(time.perf_counter() - start)
+        if seconds[-1] > slow:
+            break
+    tracemalloc.start()
+    try:
+        function(problem)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(seconds), 'seconds_all': seconds, 'peak_bytes': peak}
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd = root, capture_output = True, text = True, \
+                              check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(sizes = reference_sizes, names = None, repeat = 3):
+    opsys.set_headless()
+    names = [name for name, _, _ in stages] if names is None else names
+    unknown = set(names) - set(name for name, _, _ in stages)
+    if unknown:
+        raise Warning('unknown stages '+', '.join(sorted(unknown)))
+
+    results = []
+    def _record(name, size, problem, function):
+        print(name+(' @ '+str(size) if size else '')+' ...', flush = True)
+        results.append(dict(stage = name, size = size, **measure(function, problem, repeat)))
+        print('    '+'{:.4f}'.format(results[-1]['seconds'])+' s, '\
+              +'{:.1f}'.format(results[-1]['peak_bytes']/2**20)+' MB peak')
+
+    dataset = PSF.PSFDataset() if 'kernel_compare_config' in names else None
+    for size in sizes:
+        problem = dict(toy_problem(size), psf_dataset = dataset)
+        for name, function, sized in stages:
+            if sized and name in names:
+                _record(name, size, problem, function)
+    for name, function, sized in stages:
+        if not sized and name in names:
+            _record(name, None, None, function)
+
+    return {'created': datetime.datetime.now().isoformat(timespec = 'seconds'),
+            'commit': _commit(),
+            'python': platform.python_version(), 'numpy': np.__version__, 'scipy': scipy.__version__,
+            'machine': platform.platform(), 'cpu_count': os.cpu_count(), 'repeat': repeat,
+            'results': results}
+
+#new/old time and memory of every (stage, size) both runs have
+def compare(new, old):
+    previous = {(r['stage'], r['size']): r for r in old['results']}
+    print('stage'.ljust(30)+'size'.rjust(10)+'time new/old'.rjust(14)+'memory new/old'.rjust(16))
+    for r in new['results']:
+        if (r['stage'], r['size']) in previous:
+            o = previous[(r['stage'], r['size'])]
+            print(r['stage'].ljust(30)+str(r['size'] or '').rjust(10)\
+                  +'{:.2f}'.format(r['seconds']/o['seconds']).rjust(14)\
+                  +('{:.2f}'.format(r['peak_bytes']/o['peak_bytes']) if o['peak_bytes'] else '-').rjust(16))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Stage benchmarks of the Fabry-Perot and PSF pipelines')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = reference_sizes, help = 'virtual_steps values')
+    parser.add_argument('--stages', nargs = '+', default = None, help = 'only these stages')
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--output', default = None, help = 'json path, results/<date>.json by default')
+    parser.add_argument('--compare', default = None, help = 'an earlier json to compare against')
+    arguments = parser.parse_args()
+
+    report = run(arguments.sizes, arguments.stages, arguments.repeat)
+    output = arguments.output
+    if output is None:
+        os.makedirs(results_folder, exist_ok = True)
+        output = os.path.join(results_folder, report['created'].replace(':', '-')+'.json')
+    with open(output, 'w') as f:
+        json.dump(report, f, indent = 1)
+    print('saved '+output)
+
+    if arguments.compare is not None:
+        with open(arguments.compare, 'r') as f:
+            compare(report, json.load(f))
@@ -4,39 +4,146 @@ Created on Tue Jun  7 22:09:42 2022
 
 @author: User
 """
+import functools
+import os
+import re
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy.stats as stat
+import scipy.signal as sci
+import scipy.sparse as sparse
+import scipy.fft as sfft
 from astropy.modeling import models, fitting
-from scipy.special import erf
+from scipy.special import erf, fresnel
 from scipy.optimize import curve_fit
 from tqdm import tqdm
 
+import instrumentation
+
 ###################### OPTICAL SYSYTEM FUNCTIONS ##############################
 
+#storage precision of the transmitances, kernels and convolutions. float32
+#halves their memory and bandwidth, the phases are still computed in float64
+#and the wavelength grids, detector sums and fits always stay float64
+#(a 1e-15 step on 6e-7 is below float32 resolution)
+precision = np.float64
+
+def set_precision(dtype):
+    global precision
+    if np.dtype(dtype) not in [np.float32, np.float64]:
+        raise Warning("precision can only be float32 or float64")
+    precision = np.dtype(dtype).type
+
+def _stored(array):
+    return np.asarray(array).astype(precision, copy = False)
+
+#error budget of float32: pipeline() -> peak wavelengths(or a dict of them,
+#e.g. {'gauss': ..., 'erf': ...}) is run once per precision and the radial
+#speed shift c*(float32 - float64)/float64 [m/s] of every peak is printed and
+#returned(a dict for a dict). The precision is restored afterwards
+def precision_error_budget(pipeline, c = 3e8):
+    previous = precision
+    try:
+        set_precision(np.float64)
+        reference = pipeline()
+        set_precision(np.float32)
+        single = pipeline()
+    finally:
+        set_precision(previous)
+    named = isinstance(reference, dict)
+    if not named:
+        reference, single = {'': reference}, {'': single}
+
+    shifts = {}
+    for name in reference:
+        r = np.asarray(reference[name], dtype = float)
+        s = np.asarray(single[name], dtype = float)
+        if s.shape != r.shape:
+            raise Warning("float32 and float64 runs found a different number of "+(name+" " if name else "")+"peaks")
+        shifts[name] = c*(s - r)/r
+        print('float32 moves the '+str(r.size)+' '+(name+' ' if name else '')+'peaks by '\
+              +'{:.3e}'.format(np.sqrt(np.mean(shifts[name]**2)))+' m/s rms, '\
+              +'{:.3e}'.format(np.max(np.abs(shifts[name])))+' m/s at most')
+    return shifts if named else shifts['']
 
 def white_light_generator(lambda_min, lambda_max, lambda_divisions):
     difference = lambda_max - lambda_min
     increment = difference/lambda_divisions
     return np.arange(lambda_min, lambda_max+ increment, increment)
 
+#Non-uniform alternative to white_light_generator: starts from initial_steps
+#uniform intervals(plus the anchors, e.g. analytic_fabry_perot_peaks, so no
+#narrow line can fall between two samples) and keeps halving every interval
+#whose midpoint misses the straight line between its ends by more than tol,
+#or that is wider than max_step(keep it below the kernel width when the grid
+#is to be convolved, and about resolution/10 when the convolution is then
+#discretized on it: the toy's peaks stay within 0.06 m/s(gauss) and 0.2 m/s
+#(erf) of the dense run, without max_step they move by metres per second).
+#The samples crowd on the steep peaks and stay sparse in between.
+#transmitance(lambda) must work on arrays -> (grid, transmitance on the grid)
+@instrumentation.stage
+def adaptive_light_generator(transmitance, lambda_min, lambda_max, tol = 1e-4, \
+                             initial_steps = 1000, anchors = None, max_step = None, max_levels = 40):
+    grid = np.linspace(lambda_min, lambda_max, initial_steps + 1)
+    if anchors is not None:
+        anchors = np.asarray(anchors)
+        grid = np.union1d(grid, anchors[(anchors > lambda_min) & (anchors < lambda_max)])
+    values = transmitance(grid)
+
+    new_grid, new_values = [grid], [values]
+    left, right, f_left, f_right = grid[:-1], grid[1:], values[:-1], values[1:]
+    for level in range(max_levels):
+        middle = (left + right)/2
+        f_middle = transmitance(middle)
+        split = np.abs(f_middle - (f_left + f_right)/2) > tol
+        if max_step is not None:
+            split |= (right - left) > max_step
+        if not split.any():
+            break
+        new_grid.append(middle[split])
+        new_values.append(f_middle[split])
+        left, right = np.concatenate((left[split], middle[split])), np.concatenate((middle[split], right[split]))
+        f_left, f_right = np.concatenate((f_left[split], f_middle[split])), np.concatenate((f_middle[split], f_right[split]))
+    else:
+        print('adaptive_light_generator stopped after '+str(max_levels)+' levels, '\
+              +str(len(left))+' intervals are still above tol')
+
+    grid = np.concatenate(new_grid)
+    order = np.argsort(grid)
+    return grid[order], np.concatenate(new_values)[order]
+
+#the width every sample of a(non-uniform) grid stands for, the trapezoid weights
+def cell_widths(grid):
+    grid = np.asarray(grid)
+    widths = np.empty(len(grid))
+    widths[1:-1] = (grid[2:] - grid[:-2])/2
+    widths[0] = (grid[1] - grid[0])/2
+    widths[-1] = (grid[-1] - grid[-2])/2
+    return widths
+
+def is_uniform(grid, rtol = 1e-6):
+    steps = np.diff(grid)
+    return np.ptp(steps) <= rtol*np.abs(steps.mean())
+
 ##We assume for now that the finesse is constant for all lambda
 ## in fact finesse changes by the incedent angle for each wavelength(not reflectance)
+@instrumentation.stage
 def fabry_perot_transmitance(lambda_range, etalon_thickness, \
                              n = 1, theta = 0, F = 12.27):
     #F_coeff = 
     delta = (2*np.pi/lambda_range)*2*n*etalon_thickness*np.cos(theta)
     product = F*(np.sin(delta/2))**2
-    return 1/(1 + product) ##The transmitance
+    return _stored(1/(1 + product)) ##The transmitance
 
 ##we model the transmitance directly as a sinusoid for a simple filter
+@instrumentation.stage
 def filter_transmitance(lambda_range,filter_thickness, \
                         theta = 0, n = 1, percentage = 0.05, peak = 1):
 
     delta = (2*np.pi/lambda_range)*2*n*filter_thickness*np.cos(theta)
     amplitude = peak*percentage
     wave = (np.sin(delta/2))**2
-    return amplitude*wave+1-amplitude
+    return _stored(amplitude*wave+1-amplitude)
 
 #realistic model of an infrared fiter
 # From data sheet of 800FL07-12.5
@@ -44,39 +151,107 @@ def filter_transmitance(lambda_range,filter_thickness, \
 #reflectance of glass ~ 0.04(= R2) -> T_glass ~ 0.96
 #-> T_filter = 0.9 = T_coating * T_glass
 #-> T_coating ~ 0.9/0.96 = 0.9375 -> R_caoting(= R1) = 1 - 0.9375 = 0.0625
+@instrumentation.stage
 def accurate_filter_transmitance(lambda_range,filter_thickness, \
                                  path_length = 56.547e-3, semi_diameter = 1.129e-3, \
-                                 n = 1, R1 = 0.0625, R2 = 0.04, tilt_deg = 0):
+                                 n = 1, R1 = 0.0625, R2 = 0.04, tilt_deg = 0, \
+                                 chunk_size = 2**16, analytic = False, \
+                                 panels = 1, series_tol = 1e-8):
+    #tilt_deg can also be a vector of tilts, in which case a (tilts x lambda)
+    #array is returned, each row normalised on its own
+    #chunk_size is how many wavelengths are evaluated at once, the trapezoid
+    #works on one (chunk_size x 101) float64 array in place, about
+    #chunk_size*101*8 bytes(53MB at the default) whatever the number of tilts
+    #analytic = True skips the theta sampling altogether(see _analytic_integral)
+    #and prints how far it lands from the 100 division trapezoid
     
-    def _mini_fabry_perot(theta, one_lambda):
-        delta = (2*np.pi/one_lambda)*2*n*filter_thickness*np.cos(theta)
-        geomean = np.sqrt(R1*R2)
-        
-        numerator = (1 - R1)*(1 - R2)
-        denominator = (1-geomean)**2 + 4*geomean*(np.sin(delta/2)**2)
-        transmitance = numerator/denominator
+    geomean = np.sqrt(R1*R2)
+    numerator = (1 - R1)*(1 - R2)
+    
+    def _mini_fabry_perot(theta, lambdas):
+        #theta along the columns, wavelengths along the rows
+        #numerator/((1-geomean)**2 + 4*geomean*sin(delta/2)**2), in place
+        transmitance = (2*np.pi/lambdas[:, None])*2*n*filter_thickness*np.cos(theta)
+        transmitance /= 2
+        np.sin(transmitance, out = transmitance)
+        np.square(transmitance, out = transmitance)
+        transmitance *= 4*geomean
+        transmitance += (1-geomean)**2
+        np.divide(numerator, transmitance, out = transmitance)
         return transmitance
     
+    def _trapezoid_integral(theta_lower, theta_upper, lambdas):
+        divisions = 100
+        theta_increment = (theta_upper - theta_lower)/divisions
+        theta_integral_vector = np.arange(theta_lower, theta_upper+theta_increment, theta_increment)
+        I = _mini_fabry_perot(theta_integral_vector, lambdas)
+        return (I.sum(axis = 1) - (I[:, 0]+I[:, -1])/2)*theta_increment
+    
+    #The Airy function has the Fourier series
+    #T = numerator/(1-g^2) * [1 + 2*sum_m g^m cos(m*delta)], g = geomean
+    #so each harmonic has to be averaged over theta. On every panel cos(theta)
+    #is expanded to second order, the phase becomes quadratic and the
+    #integral is a difference of Fresnel integrals. The series is cut once
+    #g^m < series_tol, and the error of the expansion drops as panels^-3
+    def _analytic_integral(theta_lower, theta_upper, lambdas):
+        delta_0 = (2*np.pi/lambdas)*2*n*filter_thickness
+        half_width = (theta_upper - theta_lower)/(2*panels)
+        n_terms = 1 if geomean == 0 else \
+            max(1, int(np.ceil(np.log(series_tol)/np.log(geomean))))
+        I = np.full(len(lambdas), theta_upper - theta_lower)
+        for p in range(panels):
+            theta_c = theta_lower + (2*p + 1)*half_width
+            for m in range(1, n_terms + 1):
+                #phase = c0 + b*u + a*u^2 around theta_c
+                a = -m*delta_0*np.cos(theta_c)/2
+                b = -m*delta_0*np.sin(theta_c)
+                c0 = m*delta_0*np.cos(theta_c)
+                shift = b/(2*a)
+                scale = np.sqrt(-2*a/np.pi)
+                S2, C2 = fresnel(scale*(half_width + shift))
+                S1, C1 = fresnel(scale*(-half_width + shift))
+                psi = c0 - b**2/(4*a)
+                harmonic = ((C2 - C1)*np.cos(psi) + (S2 - S1)*np.sin(psi))/scale
+                I += 2*geomean**m*harmonic
+        return numerator/(1 - geomean**2)*I
+    
     def _deg2rad (deg):
         return deg*2 *np.pi/180
     
-    transmitance_array = []
-    theta_upper = np.arctan(semi_diameter/path_length)
-    theta_lower = -theta_upper
-    theta_upper, theta_lower = (_deg2rad(tilt_deg) + x for x in (theta_upper, theta_lower))
-    divisions = 100
-    theta_increment = (theta_upper - theta_lower)/divisions
-    theta_integral_vector = np.arange(theta_lower, theta_upper+theta_increment, theta_increment)
-    for wavelength in tqdm(lambda_range):
-        #####Trapezoidal Integration
-        I = _mini_fabry_perot(theta_integral_vector, wavelength)
-        I = (np.sum(I) - (I[0]+I[-1])/2)*theta_increment
-        transmitance_array.append(I)
-
-    transmitance_array /= np.max(transmitance_array)
+    if chunk_size < 1:
+        raise Warning("invalid chunk_size in accurate_filter_transmitance")
+    if analytic and (panels < 1 or not 0 < series_tol < 1):
+        raise Warning("invalid panels/series_tol in accurate_filter_transmitance")
+    
+    integral = _analytic_integral if analytic else _trapezoid_integral
+    lambda_range = np.asarray(lambda_range)
+    tilts = np.atleast_1d(tilt_deg)
+    transmitance_array = np.empty((len(tilts), len(lambda_range)), dtype = precision)
+    for t, tilt in enumerate(tilts):
+        theta_upper = np.arctan(semi_diameter/path_length)
+        theta_lower = -theta_upper
+        theta_upper, theta_lower = (_deg2rad(tilt) + x for x in (theta_upper, theta_lower))
+        for start in tqdm(range(0, len(lambda_range), chunk_size)):
+            stop = start + chunk_size
+            transmitance_array[t, start:stop] = integral(theta_lower, theta_upper, \
+                                                         lambda_range[start:stop])
+        
+        if analytic:
+            #compared on the raw integrals, about a thousand wavelengths is plenty
+            stride = max(1, len(lambda_range)//1000)
+            reference = _trapezoid_integral(theta_lower, theta_upper, lambda_range[::stride])
+            deviation = np.abs(transmitance_array[t, ::stride]/reference - 1).max()
+            print('Analytic filter transmitance @ '+str(tilt)+' deg tilt deviates by '\
+                  +'{:.3e}'.format(deviation)+' from the 100 division trapezoid')
+        
+        transmitance_array[t] /= np.max(transmitance_array[t])
+    
+    if np.ndim(tilt_deg) == 0:
+        return transmitance_array[0]
     return transmitance_array
 
 # realistic model of a neutral density filter
+@instrumentation.stage
 def neutral_density(lambda_range, R1, filter_thickness = 2e-3,\
                     n = 1.5, R2 = 0.04, theta = 0):
     
@@ -86,58 +261,404 @@ def neutral_density(lambda_range, R1, filter_thickness = 2e-3,\
     numerator = (1 - R1)*(1 - R2)
     denominator = (1-geomean)**2 + 4*geomean*(np.sin(delta/2)**2)
     transmitance = numerator/denominator
-    return transmitance
+    return _stored(transmitance)
 
 #for reference, the analytic peaks:
-def analytic_fabry_perot_peaks(lower, upper, etalon, n = 1,theta = 0):
-    k_high = int((2*n*etalon*np.cos(theta))/(upper))+1
-    k = k_high - 1
-    perfect_lambda = []
-    while True:
-        k = k + 1
-        new_lamnda = (2*n*etalon*np.cos(theta))/(k)
-        if new_lamnda < lower:
-            perfect_lambda.reverse()
-            perfect_lambda = np.asarray(perfect_lambda)
-            return perfect_lambda
-        
-        perfect_lambda.append(new_lamnda)
+#every peak 2*n*etalon*cos(theta)/k in [lower, upper), in ascending order,
+#found from the range of interference orders k directly.
+#etalon, n and theta can also be arrays(broadcast against eachother), one etalon
+#variant per element: the peaks of every variant then come back along a last
+#axis padded with nan, or as a flat list of arrays with padded = False
+def analytic_fabry_perot_peaks(lower, upper, etalon, n = 1,theta = 0, padded = True):
+    optical_path = 2*np.asarray(n)*np.asarray(etalon)*np.cos(theta)
+    k_first = np.floor(optical_path/upper).astype(np.int64) + 1
+    k_last = np.maximum(np.floor(optical_path/lower).astype(np.int64), 1)
+    #the last order is decided on the peak itself, exactly as the comb is computed
+    k_last = k_last + (optical_path/(k_last + 1) >= lower)
+    k_last = k_last - (optical_path/k_last < lower)
+    n_peaks = np.maximum(k_last - k_first + 1, 0)
+
+    if optical_path.ndim == 0:
+        return optical_path/np.arange(k_last, k_last - n_peaks, -1)
+
+    peak_number = np.arange(n_peaks.max())
+    valid = peak_number < n_peaks[..., None]
+    k = np.where(valid, k_last[..., None] - peak_number, 1)
+    perfect_lambda = np.where(valid, optical_path[..., None]/k, np.nan)
+    if padded:
+        return perfect_lambda
+    return [peaks[:count] for peaks, count in \
+            zip(perfect_lambda.reshape(-1, perfect_lambda.shape[-1]), n_peaks.ravel())]
         
 ###############################################################################
         
 #################### UTILITY AND MODELING FUNCTIONS ###########################        
+@instrumentation.stage
 def gaussian(cuttoff, sample_space, target, upper, lower, steps):
 
+    increment = (upper-lower)/steps
+    exp_gauss, xrange = gaussian_kernel(target, sample_space, cuttoff, increment)
+    #the kernel can never be wider than the range it is sampled on
+    clip = len(xrange)//2 - int(steps/2)
+    if clip > 0:
+        exp_gauss, xrange = exp_gauss[clip:-clip], xrange[clip:-clip]
+    return _stored(exp_gauss), xrange
+
+#exp(-x^2/(2sigma^2)) > cuttoff only for |x| < sigma*sqrt(-2ln(cuttoff)), so only
+#that support is allocated instead of the whole wavelength range.
+#Kernels are memoised, repeated configurations in a sweep cost nothing, which
+#is also why the returned arrays are read only
+@functools.lru_cache(maxsize = 128)
+def gaussian_kernel(target, sample_space, cuttoff, increment):
+    if not 0 < cuttoff < 1:
+        raise Warning("invalid cuttoff in gaussian_kernel")
+    
     gaussian_resolution = target/sample_space #the FWHM we want
     sigma_guassian = gaussian_resolution/(2*np.sqrt(2*np.log(2)))
-
-    increment = (upper-lower)/steps
-    xrange = np.arange(-int(steps/2)*increment, \
-                       (int(steps/2)+1)*increment, increment)
+    
+    #one extra sample on each side, the exact edge is decided by the cuttoff below
+    half_steps = int(sigma_guassian*np.sqrt(-2*np.log(cuttoff))/increment) + 1
+    xrange = np.arange(-half_steps, half_steps + 1)*increment
     #mag_gauss = (1/(np.sqrt(2*np.pi)*sigma_guassian))
     exp_gauss = np.exp(-(xrange**2)/(2*sigma_guassian**2))
     indexes = exp_gauss > cuttoff*np.max(exp_gauss)
     exp_gauss = exp_gauss[indexes]
     #gauss = mag_gauss*exp_gauss
     xrange = xrange[indexes]
+    
+    exp_gauss.setflags(write = False)
+    xrange.setflags(write = False)
     return exp_gauss, xrange
     
+#same result as np.convolve(kernel, signal, mode = 'same'), normalised to a
+#peak of 1 like the driver scripts do, but the strategy is picked from the sizes:
+#'direct' for tiny kernels, 'oa'(overlap-add) when the signal is much longer
+#than the kernel and 'fft' otherwise
+@instrumentation.stage
+def kernel_convolution(kernel, signal, method = 'auto', normalise = True):
+    kernel = np.asarray(kernel)
+    signal = np.asarray(signal)
+    #'same' is always relative to the longer of the two, as in numpy
+    longer, shorter = (signal, kernel) if len(signal) >= len(kernel) else (kernel, signal)
+    
+    if method == 'auto':
+        method = convolution_method(len(longer), len(shorter))
+    
+    if method == 'direct':
+        convolution = np.convolve(kernel, signal, mode = 'same')
+    elif method == 'fft':
+        convolution = sci.fftconvolve(longer, shorter, mode = 'same')
+    elif method == 'oa':
+        convolution = sci.oaconvolve(longer, shorter, mode = 'same')
+    else:
+        raise Warning("invalid method in kernel_convolution")
+    
+    if normalise:
+        convolution /= convolution.max()
+    return _stored(convolution)
+
+#every signal against every kernel, result[i, j] is
+#kernel_convolution(kernels[j], signals[i]). Each signal and each kernel is
+#transformed once, only the inverse transforms scale with signals*kernels
+#signals must share a length and be at least as long as every kernel
+@instrumentation.stage
+def batch_kernel_convolution(kernels, signals, normalise = True):
+    signals = np.atleast_2d(signals)
+    if np.ndim(kernels[0]) == 0: #a single kernel
+        kernels = [kernels]
+    kernels = [np.asarray(k) for k in kernels]
+    n_signal = signals.shape[1]
+    if max(len(k) for k in kernels) > n_signal:
+        raise Warning("kernel longer than signal in batch_kernel_convolution")
+    
+    fft_length = sfft.next_fast_len(n_signal + max(len(k) for k in kernels) - 1, real = True)
+    signal_spectra = sfft.rfft(signals, fft_length, axis = -1)
+    
+    result = np.empty((len(signals), len(kernels), n_signal), dtype = precision)
+    for j, kernel in enumerate(kernels):
+        kernel_spectrum = sfft.rfft(kernel, fft_length)
+        full = sfft.irfft(signal_spectra*kernel_spectrum, fft_length, axis = -1)
+        start = (len(kernel) - 1)//2 #'same' alignment
+        result[:, j] = full[:, start:start + n_signal]
+    
+    if normalise:
+        result /= result.max(axis = -1, keepdims = True)
+    return result
+
+#rough crossover points, measured with numpy/scipy on 1e5-1e6 sample signals
+def convolution_method(n_signal, n_kernel):
+    if n_kernel <= 64:
+        return 'direct'
+    if n_signal >= 64*n_kernel:
+        return 'oa'
+    return 'fft'
+
+#kernel_convolution for a signal on a non-uniform grid(adaptive_light_generator).
+#kernel is sampled every kernel_increment around its centre sample (len-1)//2,
+#as gaussian() and the PSF kernels are, and is linearly interpolated at every
+#separation of two grid points; each signal sample weighs its cell width. On a
+#uniform grid with grid step = kernel_increment this is kernel_convolution.
+#The result is given at the points in at(the grid itself by default), only
+#pairs within the kernel support are formed, chunk_size of them at a time.
+#Sparse stretches of the grid leave ripples of ~1e-7 between the lines, give
+#find_peaks a prominence
+@instrumentation.stage
+def nonuniform_convolution(kernel, kernel_increment, grid, signal, at = None, \
+                           normalise = True, chunk_size = 2**22):
+    kernel = np.asarray(kernel, dtype = float)
+    grid = np.asarray(grid)
+    at = grid if at is None else np.asarray(at)
+    centre = (len(kernel) - 1)//2
+    kernel_axis = np.arange(len(kernel))
+    weighted = np.asarray(signal)*cell_widths(grid)/kernel_increment
+
+    #grid[j] contributes to at[i] when at[i] - grid[j] lies on the kernel
+    first = np.searchsorted(grid, at - (len(kernel) - 1 - centre)*kernel_increment, 'left')
+    last = np.searchsorted(grid, at + centre*kernel_increment, 'right')
+    pairs = np.cumsum(last - first)
+
+    convolution = np.zeros(len(at))
+    start = 0
+    while start < len(at):
+        done = pairs[start - 1] if start > 0 else 0
+        stop = max(start + 1, int(np.searchsorted(pairs, done + chunk_size, 'right')))
+        counts = last[start:stop] - first[start:stop]
+        rows = np.repeat(np.arange(stop - start), counts)
+        columns = np.repeat(first[start:stop] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        position = centre + (at[start + rows] - grid[columns])/kernel_increment
+        convolution[start:stop] = np.bincount(rows, weights = weighted[columns]*np.interp(position, kernel_axis, kernel),\
+                                              minlength = stop - start)
+        start = stop
+
+    if normalise:
+        convolution /= convolution.max()
+    return _stored(convolution)
+
+#Peak guided mode: instead of the whole white_light_generator grid only a
+#window around every expected peak(e.g. analytic_fabry_perot_peaks) is
+#evaluated, so the cost follows the number of lines and not the band.
+#Windows sit on the lattice of white_light_generator(lambda_min, ...), a window
+#sample is exactly the dense sample of the same wavelength(np.arange steps by
+#(start+step)-start, not by step). offset(in samples) moves every window,
+#extra_left/right widen them for the convolution halo
+def peak_windows(peaks, lambda_min, increment, half_width, offset = 0, extra_left = 0, extra_right = 0):
+    step = (lambda_min + increment) - lambda_min
+    centre = np.rint((np.asarray(peaks) - lambda_min)/step).astype(np.int64) + offset
+    samples = np.arange(-half_width - extra_left, half_width + extra_right + 1)
+    return lambda_min + (centre[:, None] + samples)*step
+
+#transmitance(lambda) convolved with kernel, in the windows of peak_windows only
+#('same' alignment, as kernel_convolution on the dense grid) -> (window
+#wavelengths, window convolutions), 2*half_width+1 samples per window
+def _window_convolution(transmitance, kernel, peaks, lambda_min, increment, half_width, offset):
+    centre = (len(kernel) - 1)//2
+    halo_left = len(kernel) - 1 - centre
+    windows = peak_windows(peaks, lambda_min, increment, half_width, offset, halo_left, centre)
+    convolution = sci.fftconvolve(transmitance(windows), kernel[None, :], mode = 'valid', axes = -1)
+    return windows[:, halo_left:halo_left + 2*half_width + 1], convolution
+
+#transmitance(lambda) -> convolved with kernel -> peak positions, evaluated only
+#around the expected peaks. A skewed kernel moves every peak by about the same
+#number of samples, anywhere within its support: unless offset is given that
+#shift is found once, on the middle line searched over the whole kernel, and
+#every line is then searched within +/-half_width samples of it.
+#Memory and time go as lines*(len(kernel) + 2*half_width).
+#subsample = True refines each maximum with a parabola through its 3 samples,
+#otherwise the grid wavelength of the maximum is returned(as find_peaks would)
+#-> (peaks, window wavelengths, window convolutions)
+@instrumentation.stage
+def windowed_peaks(transmitance, kernel, expected_peaks, lambda_min, increment, half_width = 64, \
+                   offset = None, subsample = True, normalise = True):
+    kernel = np.asarray(kernel, dtype = float)
+    expected_peaks = np.asarray(expected_peaks)
+    if expected_peaks.size == 0:
+        raise Warning("no expected peaks in windowed_peaks")
+
+    if offset is None:
+        probe = len(kernel)
+        _, convolution = _window_convolution(transmitance, kernel, expected_peaks[[len(expected_peaks)//2]], \
+                                             lambda_min, increment, probe, 0)
+        offset = int(np.argmax(convolution[0])) - probe
+
+    windows, convolution = _window_convolution(transmitance, kernel, expected_peaks, lambda_min, \
+                                               increment, half_width, offset)
+    if normalise:
+        convolution /= convolution.max()
+
+    top = np.argmax(convolution, axis = -1)
+    if np.any(top == 0) or np.any(top == 2*half_width):
+        raise Warning("peak at the edge of its window in windowed_peaks, increase half_width or fix offset")
+    rows = np.arange(len(windows))
+    peaks = windows[rows, top]
+    if subsample:
+        left, middle, right = convolution[rows, top - 1], convolution[rows, top], convolution[rows, top + 1]
+        peaks = peaks + 0.5*(left - right)/(left - 2*middle + right)*(windows[0, 1] - windows[0, 0])
+    return peaks, windows, convolution
+
+#On a non-uniform grid(adaptive_light_generator) each bin is the mean of the
+#straight lines between the samples over the bin, a plain mean would lean
+#towards the densely sampled peaks
+@instrumentation.stage
 def discretize(lambda_range, y_value, resolution, upper, lower):
+    detector = DetectorBinning(lambda_range, resolution, upper, lower)
+    return detector(y_value), detector.centres
 
-    statistic, edges, _ = stat.binned_statistic(lambda_range, y_value, \
-                                bins = int((upper-lower)/resolution))
+#(bins x samples) matrix of the exact bin means of the piecewise linear
+#interpolant of a non-uniform grid(any order). The grid and the edges are
+#merged, each piece lies in one cell and one bin and adds its integral of the
+#two hat functions of the cell to that bin
+def _integral_matrix(lambda_range, edges):
+    order = np.argsort(lambda_range, kind = 'stable')
+    grid = lambda_range[order]
+    points = np.union1d(grid, edges)
+    lower, upper = points[:-1], points[1:]
+    middle = (lower + upper)/2
+    cell = np.clip(np.searchsorted(grid, middle, 'right') - 1, 0, len(grid) - 2)
+    bin_index = np.clip(np.searchsorted(edges, middle, 'right') - 1, 0, len(edges) - 2)
+    width = grid[cell + 1] - grid[cell]
+    s_lower, s_upper = (lower - grid[cell])/width, (upper - grid[cell])/width
+    right = width*(s_upper**2 - s_lower**2)/2
+    left = (upper - lower) - right
+    scale = 1/np.diff(edges)[bin_index]
+    return sparse.csr_matrix((np.concatenate((left*scale, right*scale)), \
+                              (np.concatenate((bin_index, bin_index)), np.concatenate((order[cell], order[cell + 1])))), \
+                             shape = (len(edges) - 1, len(lambda_range)))
 
-    for i in range(len(edges)-1):
-        edges[i] = (edges[i]+edges[i+1])/2
-    edges = np.delete(edges, -1)
-    
-    return statistic, edges
+#discretize as an operator, the bins of a grid are found once and any number
+#of spectra sampled on it are then binned in one call: a (..., len(lambda_range))
+#stack gives (..., bins). The bins are those of binned_statistic(bins =
+#int((upper-lower)/resolution)), empty ones are nan.
+#Equal bins of a sorted grid are a reshape and mean, unequal ones a reduceat,
+#an unsorted grid goes through a sparse(bins x samples) averaging matrix.
+#A non-uniform grid goes through the sparse matrix of _integral_matrix, the
+#bins are then integrals and none is empty
+class DetectorBinning:
+
+    @instrumentation.stage
+    def __init__(self, lambda_range, resolution, upper, lower):
+        lambda_range = np.asarray(lambda_range)
+        self.n_samples = len(lambda_range)
+        self.n_bins = int((upper-lower)/resolution)
+        _, self.edges, binnumber = stat.binned_statistic(lambda_range, np.zeros(self.n_samples), \
+                                                         statistic = 'count', bins = self.n_bins)
+        self.centres = (self.edges[:-1] + self.edges[1:])/2
+        self.index = binnumber - 1
+        self.counts = np.bincount(self.index, minlength = self.n_bins)
+        self.filled = self.counts > 0
 
+        ordered = np.all(np.diff(self.index) >= 0)
+        self.uniform = is_uniform(lambda_range if np.all(np.diff(lambda_range) >= 0) else np.sort(lambda_range))
+        if not self.uniform:
+            self.method = 'integral'
+            self.filled = np.ones(self.n_bins, dtype = bool)
+            self.matrix = _integral_matrix(lambda_range, self.edges)
+        elif ordered:
+            if np.all(self.counts == self.counts[0]):
+                self.method = 'reshape'
+            else:
+                self.method = 'reduceat'
+                self.starts = np.concatenate(([0], np.cumsum(self.counts)[:-1]))[self.filled]
+        else:
+            self.method = 'sparse'
+            self.matrix = sparse.csr_matrix((1/self.counts[self.index], (self.index, np.arange(self.n_samples))), \
+                                            shape = (self.n_bins, self.n_samples))
+
+    @instrumentation.stage
+    def __call__(self, spectra):
+        spectra = np.asarray(spectra)
+        if spectra.shape[-1] != self.n_samples:
+            raise Warning("spectra do not match the grid of this DetectorBinning")
+        if self.method == 'reshape':
+            return spectra.reshape(spectra.shape[:-1] + (self.n_bins, self.counts[0])).mean(axis = -1, dtype = np.float64)
+
+        binned = np.full(spectra.shape[:-1] + (self.n_bins,), np.nan)
+        if self.method == 'reduceat':
+            binned[..., self.filled] = np.add.reduceat(spectra, self.starts, axis = -1, dtype = np.float64)\
+                /self.counts[self.filled]
+        else:
+            flat = spectra.reshape(-1, self.n_samples)
+            binned[..., self.filled] = (self.matrix @ flat.T).T.reshape(spectra.shape[:-1] + (self.n_bins,))[..., self.filled]
+        return binned
+
+#The whole chain(transmitance -> convolution -> discretize -> fits) walked
+#through the band in chunks, for bands far too wide to be held as one
+#white_light_generator array. Chunks end on pixel edges of the dense
+#DetectorBinning and carry a halo of len(kernel) samples, so their pixels are
+#those of the dense run; lines cut by a chunk end are fitted with the next
+#chunk(the pixels from the last valley on are carried over).
+#transmitance(lambda) must not depend on the range it is given, e.g.
+#accurate_filter_transmitance normalises over its range: scale it once outside.
+#The convolution is normalised by the kernel area and not by its maximum,
+#that would need the whole band, the fits do not see the difference.
+#Yields (pixel centres, pixels, peaks) chunk by chunk, peaks are the gaussian
+#means(fit = 'gauss'), the erf means(fit = 'erf') or empty(fit = None).
+#Memory stays at a few arrays of chunk_samples, whatever the band
+def stream_band(transmitance, kernel, lambda_min, lambda_max, increment, resolution, \
+                chunk_samples = 2**20, fit = 'gauss', vtol = 0.05, weights = 0):
+    if fit not in ['gauss', 'erf', None]:
+        raise Warning("invalid fit in stream_band")
+    kernel = np.asarray(kernel, dtype = float)
+    kernel = _stored(kernel/kernel.sum())
+    centre = (len(kernel) - 1)//2
+    halo_left = len(kernel) - 1 - centre
+
+    #the white_light_generator lattice, sample i is lambda_min + i*step
+    step = (lambda_min + increment) - lambda_min
+    n_samples = int(np.ceil((lambda_max + increment - lambda_min)/increment))
+    n_bins = int((lambda_max - lambda_min)/resolution)
+    edges = np.linspace(lambda_min, lambda_min + (n_samples - 1)*step, n_bins + 1)
+    centres = (edges[:-1] + edges[1:])/2
+    #first sample of every pixel, the last pixel also takes the last sample
+    first = np.ceil((edges - lambda_min)/step).astype(np.int64)
+    first -= lambda_min + (first - 1)*step >= edges
+    first += lambda_min + first*step < edges
+    first[0], first[-1] = 0, n_samples
+
+    pixels_per_chunk = max(1, int(chunk_samples*n_bins//n_samples))
+    carry_centres, carry_pixels = np.empty(0), np.empty(0)
+    starts_on_valley = False
+    for p0 in tqdm(range(0, n_bins, pixels_per_chunk)):
+        #one record per chunk, the work up to the yield
+        with instrumentation.measure('stream_band.chunk'):
+            p1 = min(p0 + pixels_per_chunk, n_bins)
+            i0, i1 = first[p0], first[p1]
+            index = np.arange(i0 - halo_left, i1 + centre)
+            inside = (index >= 0) & (index < n_samples)
+            signal = np.zeros(len(index), dtype = precision)
+            signal[inside] = transmitance(lambda_min + index[inside]*step)
+            convolution = sci.fftconvolve(signal, kernel, mode = 'valid')
+
+            counts = np.diff(first[p0:p1 + 1])
+            filled = counts > 0
+            pixels = np.full(p1 - p0, np.nan)
+            if filled.any():
+                pixels[filled] = np.add.reduceat(convolution, first[p0:p1][filled] - i0, dtype = np.float64)/counts[filled]
+
+            peaks = np.empty(0)
+            if fit is not None:
+                carry_centres = np.concatenate((carry_centres, centres[p0:p1]))
+                carry_pixels = np.concatenate((carry_pixels, pixels))
+                valleys = sci.find_peaks(-carry_pixels)[0]
+                if starts_on_valley:
+                    valleys = np.concatenate(([0], valleys))
+                if len(valleys) > 1:
+                    means, stds = batch_gauss_model(None, valleys, carry_pixels, carry_centres, vtol = vtol, \
+                                                    show = False, weights = weights)
+                    peaks = np.array(means)
+                    if fit == 'erf':
+                        peaks = np.array(batch_erf_model(None, valleys, carry_pixels, carry_centres, means, stds, \
+                                                         increment, vtol = vtol, show = False, weights = weights))
+                if len(valleys) > 0:
+                    carry_centres, carry_pixels = carry_centres[valleys[-1]:], carry_pixels[valleys[-1]:]
+                    starts_on_valley = True
+        yield centres[p0:p1], pixels, peaks
+
+@instrumentation.stage
 def gauss_model(peaks, valleys, d_conv, edg, perfect, vtol = 0, show = True , weights = 0):
     #"show", "perfect" variables mainly used for debugging
     mean_package = []
     std_package = []
-    if show: plt.figure()
+    if show: pyplot.figure()
     for i in range(len(valleys)-1):
         indices = np.arange(valleys[i],valleys[i+1]+1,1)
         indices = indices[d_conv[indices] > vtol*(d_conv[indices].max())]
@@ -160,19 +681,117 @@ def gauss_model(peaks, valleys, d_conv, edg, perfect, vtol = 0, show = True , we
         else:
             raise Warning("invalid weight in gauss_model")
             
-        dummy_x = np.arange(x[0],x[-1], 1e-14)
         if show: 
+            dummy_x = np.linspace(x[0], x[-1], 200)
             #dummy_perfect = [1 for i in range(len(perfect))]
-            plt.plot(x,y,'*', dummy_x,g(dummy_x), g.mean.value, g.amplitude.value, 'bo')# perfect, dummy_perfect,'ro',
+            pyplot.plot(x,y,'*', dummy_x,g(dummy_x), g.mean.value, g.amplitude.value, 'bo')# perfect, dummy_perfect,'ro',
         mean_package.append(g.mean.value)
         std_package.append(g.stddev.value)
     if show:
-        plt.xlabel("Wavelength [nm]")
-        plt.ylabel("Transmission")
-        plt.grid()
-        plt.show()
+        pyplot.xlabel("Wavelength [nm]")
+        pyplot.ylabel("Transmission")
+        pyplot.grid()
+        pyplot.show()
     return mean_package, std_package
 
+#valley to valley windows as one padded (windows x samples) matrix, samples
+#outside a window or under vtol*(window max) are masked out
+def _valley_windows(valleys, d_conv, edg, vtol):
+    valleys = np.asarray(valleys)
+    samples = np.arange((valleys[1:] - valleys[:-1]).max() + 1)
+    indices = valleys[:-1, None] + samples
+    mask = indices <= valleys[1:, None]
+    indices = np.where(mask, indices, valleys[1:, None])
+    y = d_conv[indices]
+    mask &= y > vtol*np.where(mask, y, -np.inf).max(axis = 1, keepdims = True)
+    return edg[indices], y, mask
+
+#Levenberg-Marquardt on many small independent fits at once, one row of the
+#(fits x samples) matrices each. model(p) -> (values, jacobian) and the
+#residuals are w*(values - y), every iteration solves the normal equations of
+#all the rows together. Rows stop once a step no longer moves their parameters
+def _batch_levenberg_marquardt(model, p, y, w, max_iterations = 200, tol = 1e-12):
+    p = np.array(p, dtype = float)
+    values, jacobian = model(p)
+    r = w*(values - y)
+    cost = np.sum(r**2, axis = 1)
+    damping = np.full(len(p), 1e-3)
+    active = np.ones(len(p), dtype = bool)
+    identity = np.eye(p.shape[1])
+    for iteration in range(max_iterations):
+        J = w[..., None]*jacobian
+        JtJ = np.einsum('nli,nlj->nij', J, J)
+        gradient = np.einsum('nli,nl->ni', J, r)
+        diagonal = np.diagonal(JtJ, axis1 = 1, axis2 = 2)
+        diagonal = np.maximum(diagonal, 1e-12*diagonal.max(axis = 1, keepdims = True))
+        step = np.linalg.solve(JtJ + (damping[:, None]*diagonal)[..., None]*identity, -gradient[..., None])[..., 0]
+        step[~active] = 0
+
+        trial_values, trial_jacobian = model(p + step)
+        trial_r = w*(trial_values - y)
+        trial_cost = np.sum(trial_r**2, axis = 1)
+        better = active & (trial_cost <= cost)
+        p[better] += step[better]
+        jacobian[better], r[better], cost[better] = trial_jacobian[better], trial_r[better], trial_cost[better]
+        damping = np.where(better, damping/10, damping*10)
+
+        active &= ~((np.abs(step) <= tol*(np.abs(p) + tol)).all(axis = 1) | (damping > 1e16))
+        if not active.any():
+            break
+    return p
+
+#gauss_model for all the windows at once(see _batch_levenberg_marquardt), with
+#the same start(amplitude 1, mean at the window centre, stddev a tenth of
+#the window) and the same weighted residuals weights*(model - y) as the
+#astropy fitter. x is scaled per window, so the solve is well conditioned
+#in wavelength units. -> (mean_package, std_package)
+@instrumentation.stage
+def batch_gauss_model(peaks, valleys, d_conv, edg, perfect = None, vtol = 0, show = True, weights = 0, \
+                      max_iterations = 200, tol = 1e-12):
+    #no window between two valleys, as gauss_model
+    if len(valleys) < 2:
+        return [], []
+    x, y, mask = _valley_windows(valleys, d_conv, edg, vtol)
+    rows = np.arange(len(x))
+    x_first = x[rows, np.argmax(mask, axis = 1)]
+    x_last = x[rows, mask.shape[1] - 1 - np.argmax(mask[:, ::-1], axis = 1)]
+    centre = (x_last - x_first)/2 + x_first
+    scale = np.abs(x_last - x_first)/2
+    t = np.where(mask, (x - centre[:, None])/scale[:, None], 0)
+
+    if weights == 0:
+        w = np.ones_like(y)
+    elif weights == 1:
+        w = y**2
+    elif weights == 2:
+        w = 1/np.sqrt(np.where(mask, y, 1))
+    else:
+        raise Warning("invalid weight in batch_gauss_model")
+    w = np.where(mask, w, 0)
+
+    #amplitude, mean and stddev, the last two in units of scale
+    def _gaussian(p):
+        a, mu, s = p[:, 0, None], p[:, 1, None], p[:, 2, None]
+        u = t - mu
+        shape = np.exp(-u**2/(2*s**2))
+        return a*shape, np.stack((shape, a*shape*u/s**2, a*shape*u**2/s**3), axis = -1)
+    p = _batch_levenberg_marquardt(_gaussian, np.tile([1., 0., 0.2], (len(x), 1)), y, w, max_iterations, tol)
+
+    mean_package = list(centre + p[:, 1]*scale)
+    std_package = list(np.abs(p[:, 2])*scale)
+    if show:
+        pyplot.figure()
+        for i in range(len(x)):
+            dummy_x = np.linspace(x_first[i], x_last[i], 200)
+            model = p[i, 0]*np.exp(-(dummy_x - mean_package[i])**2/(2*std_package[i]**2))
+            pyplot.plot(x[i][mask[i]], y[i][mask[i]], '*', dummy_x, model, mean_package[i], p[i, 0], 'bo')
+        pyplot.xlabel("Wavelength [nm]")
+        pyplot.ylabel("Transmission")
+        pyplot.grid()
+        pyplot.show()
+    return mean_package, std_package
+
+@instrumentation.stage
 def erf_model(peaks, valleys, d_conv, edg, means, stds, incr, vtol = 0, show = True, weights = False):
     
     mean_package = []
@@ -180,7 +799,7 @@ def erf_model(peaks, valleys, d_conv, edg, means, stds, incr, vtol = 0, show = T
     def _erfunc(x, mFL =0, a=0, b=1,c=0):
         return mFL*erf((x-a)/(b*np.sqrt(2))) + c
     
-    if show: plt.figure()
+    if show: pyplot.figure()
     for i in range(len(valleys)-1):
         indices = np.arange(valleys[i],valleys[i+1]+1,1)
         indices = indices[d_conv[indices] > vtol*(d_conv[indices].max())]
@@ -205,16 +824,217 @@ def erf_model(peaks, valleys, d_conv, edg, means, stds, incr, vtol = 0, show = T
         params, extras = curve_fit(_erfunc, x, my_erf, \
                                    p0 = [1e-16,means[i],stds[i], 0], \
                                    sigma = my_sig, method='lm')#std = 0.4e-6
-        plt.plot(x,my_erf,'*',x,_erfunc(x, *params))#params[1] are the means
+        if show: pyplot.plot(x,my_erf,'*',x,_erfunc(x, *params))#params[1] are the means
         mean_package.append(params[1])
 
     if show:
-        plt.xlabel("Wavelength [nm]")
-        plt.ylabel("Sampled erf(not normalised)")
-        plt.grid()
-        plt.show()
+        pyplot.xlabel("Wavelength [nm]")
+        pyplot.ylabel("Sampled erf(not normalised)")
+        pyplot.grid()
+        pyplot.show()
+    return mean_package
+
+#erf_model for all the windows at once: the running trapezoid sums of every
+#window come from one cumulative sum over the padded window matrix(the samples
+#over vtol are packed together first, as erf_model drops the others) and all
+#the erf fits share one batched least squares solve, seeded from the gaussian
+#means and stds. Residuals are divided by the same sigma as in the curve_fit
+#call. x and the integrals are scaled per window for the solve -> mean_package
+@instrumentation.stage
+def batch_erf_model(peaks, valleys, d_conv, edg, means, stds, incr, vtol = 0, show = True, weights = False, \
+                    max_iterations = 200, tol = 1e-12):
+    #no window between two valleys, as erf_model
+    if len(valleys) < 2:
+        return []
+    x, y, mask = _valley_windows(valleys, d_conv, edg, vtol)
+    order = np.argsort(~mask, axis = 1, kind = 'stable')
+    x, y = np.take_along_axis(x, order, axis = 1), np.take_along_axis(y, order, axis = 1)
+    count = mask.sum(axis = 1)
+
+    #sample j+1 of a window holds the integral up to it
+    valid = np.arange(1, x.shape[1]) < count[:, None]
+    x, y_right = x[:, 1:], y[:, 1:]
+    my_erf = np.cumsum(np.where(valid, incr*(y[:, :-1] + y_right)/2, 0), axis = 1)
+
+    if weights == 0:
+        my_sig = y_right
+    elif weights == 1:
+        my_sig = y_right**2
+    elif weights == 2:
+        my_sig = 1/np.sqrt(np.where(valid, y_right, 1))
+    else:
+        raise Warning("invalid weight in batch_erf_model")
+    w = np.where(valid, 1/np.where(valid, my_sig, 1), 0)
+
+    means = np.asarray(means, dtype = float)
+    stds = np.asarray(stds, dtype = float)
+    height = np.where(valid, my_erf, 0).max(axis = 1)
+    t = np.where(valid, (x - means[:, None])/stds[:, None], 0)
+    E = my_erf/height[:, None]
+
+    #mFL, a, b, c of _erfunc, a and b in units of stds around means, mFL and c in units of height
+    def _erfunc(p):
+        m, a, b, c = (p[:, k, None] for k in range(4))
+        z = (t - a)/(b*np.sqrt(2))
+        bump = m*2/np.sqrt(np.pi)*np.exp(-z**2)
+        return m*erf(z) + c, np.stack((erf(z), -bump/(b*np.sqrt(2)), -bump*z/b, np.ones_like(z)), axis = -1)
+    #a and b start from the gaussian fit, mFL and c(linear) from their least
+    #squares values there: the 1e-16 guess of erf_model is too far off for
+    #an undamped first step
+    shape = np.where(valid, erf(t/np.sqrt(2)), 0)
+    W = (w*height[:, None])**2
+    normal = np.array([[np.sum(W*shape*shape, axis = 1), np.sum(W*shape, axis = 1)],\
+                       [np.sum(W*shape, axis = 1), np.sum(W, axis = 1)]]).transpose(2, 0, 1)
+    linear = np.linalg.solve(normal, np.stack((np.sum(W*shape*E, axis = 1), np.sum(W*E, axis = 1)), axis = -1)[..., None])[..., 0]
+    start = np.column_stack((linear[:, 0], np.zeros(len(x)), np.ones(len(x)), linear[:, 1]))
+    p = _batch_levenberg_marquardt(_erfunc, start, E, w*height[:, None], max_iterations, tol)
+
+    mean_package = list(means + p[:, 1]*stds)
+    if show:
+        pyplot.figure()
+        for i in range(len(x)):
+            xi = x[i][valid[i]]
+            pyplot.plot(xi, my_erf[i][valid[i]], '*', xi, height[i]*_erfunc(p[[i]])[0][0][valid[i]])
+        pyplot.xlabel("Wavelength [nm]")
+        pyplot.ylabel("Sampled erf(not normalised)")
+        pyplot.grid()
+        pyplot.show()
     return mean_package
 
 ###############################################################################
 
 ####################### USEFUL PLOTTING DEFINITIONS ###########################
+
+#min/max of y in buckets of equal sample count, kept in sample order, so a
+#line through the result covers exactly the pixels the full line would.
+#Arrays up to 2*buckets long are returned as they are
+def decimate(x, y, buckets = 1000):
+    x, y = np.asarray(x), np.asarray(y)
+    if y.ndim != 1 or x.shape != y.shape or len(y) <= 2*buckets:
+        return x, y
+    size = len(y)//buckets
+    starts = np.arange(buckets)*size
+    body = y[:buckets*size].reshape(buckets, size)
+    tail = y[buckets*size:]
+    keep = [[0, len(y) - 1], starts + np.argmin(np.where(np.isnan(body), np.inf, body), axis = 1),\
+            starts + np.argmax(np.where(np.isnan(body), -np.inf, body), axis = 1)]
+    if len(tail):
+        keep += [[buckets*size + np.argmin(np.where(np.isnan(tail), np.inf, tail)),\
+                  buckets*size + np.argmax(np.where(np.isnan(tail), -np.inf, tail))]]
+    keep = np.unique(np.concatenate(keep))
+    return x[keep], y[keep]
+
+#plot(x, y, fmt, x2, y2, ...) arguments with every line decimated to two
+#min/max pairs per horizontal pixel of the axes(one pair leaves the
+#antialiasing visibly different)
+def _decimated_arguments(axes, args):
+    buckets = max(200, 2*int(axes.bbox.width))
+    args, decimated = list(args), []
+    while args:
+        if len(args) > 1 and not isinstance(args[1], str):
+            x, y = args.pop(0), args.pop(0)
+        else:
+            y = args.pop(0)
+            x = np.arange(np.shape(y)[0]) if np.ndim(y) > 0 else y
+        decimated += list(decimate(x, y, buckets))
+        if args and isinstance(args[0], str):
+            decimated.append(args.pop(0))
+    return decimated
+
+class _DecimatedAxes:
+
+    def __init__(self, axes):
+        self._axes = axes
+
+    def __getattr__(self, name):
+        return getattr(self._axes, name)
+
+    def plot(self, *args, **kwargs):
+        return self._axes.plot(*_decimated_arguments(self._axes, args), **kwargs)
+
+#stands in for every figure, axes and call when nothing is to be drawn
+class _Nothing:
+
+    def __getattr__(self, name):
+        return self
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+    def __getitem__(self, index):
+        return self
+
+    def __iter__(self):
+        return iter(())
+
+#headless = True draws nothing at all, unless save_to is a folder: figures are
+#then drawn off screen(Agg) and show() writes every open figure there as png.
+#OPSYS_HEADLESS=1 or OPSYS_HEADLESS=folder sets it without touching the scripts
+headless = False
+save_to = None
+_saved_figures = 0
+
+def set_headless(on = True, folder = None):
+    global headless, save_to
+    headless, save_to = on, folder
+    if on:
+        plt.switch_backend('Agg')
+        if folder is not None:
+            os.makedirs(folder, exist_ok = True)
+
+#matplotlib.pyplot for the driver scripts(plt = opsys.pyplot): lines are
+#decimated before they are drawn, plt.bar and everything else go straight
+#through, and the headless mode above is respected
+class _Pyplot:
+
+    def __getattr__(self, name):
+        if headless and save_to is None:
+            return _Nothing()
+        return getattr(plt, name)
+
+    def plot(self, *args, **kwargs):
+        if headless and save_to is None:
+            return _Nothing()
+        return _DecimatedAxes(plt.gca()).plot(*args, **kwargs)
+
+    def gca(self):
+        if headless and save_to is None:
+            return _Nothing()
+        return _DecimatedAxes(plt.gca())
+
+    def subplots(self, nrows = 1, ncols = 1, **kwargs):
+        if headless and save_to is None:
+            #axes shaped as matplotlib's, so that fig, (a1, a2) = plt.subplots(2, 1) unpacks
+            shape = (nrows, ncols) if not kwargs.get('squeeze', True) else \
+                tuple(n for n in (nrows, ncols) if n > 1)
+            if not shape:
+                return _Nothing(), _Nothing()
+            nothing = np.empty(shape, dtype = object)
+            nothing.fill(_Nothing())
+            return _Nothing(), nothing
+        figure, axes = plt.subplots(nrows, ncols, **kwargs)
+        if isinstance(axes, np.ndarray):
+            wrapped = np.empty(axes.shape, dtype = object)
+            for index, a in np.ndenumerate(axes):
+                wrapped[index] = _DecimatedAxes(a)
+            return figure, wrapped
+        return figure, _DecimatedAxes(axes)
+
+    def show(self, *args, **kwargs):
+        global _saved_figures
+        if not headless:
+            return plt.show(*args, **kwargs)
+        if save_to is None:
+            return
+        for number in plt.get_fignums():
+            figure = plt.figure(number)
+            title = figure.axes[0].get_title() if figure.axes else ''
+            title = re.sub(r'[^0-9A-Za-z]+', '_', title).strip('_')[:60]
+            _saved_figures += 1
+            figure.savefig(os.path.join(save_to, 'figure_'+str(_saved_figures).zfill(3)+('_'+title if title else '')+'.png'))
+        plt.close('all')
+
+pyplot = _Pyplot()
+
+if os.environ.get('OPSYS_HEADLESS'):
+    set_headless(True, None if os.environ['OPSYS_HEADLESS'] == '1' else os.environ['OPSYS_HEADLESS'])
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of the arrays of OpticalSystems(transmitances, convolutions...),
+keyed by the function and its arguments and memory-mapped on load.
+
+@author: User
+"""
+import numpy as np
+import hashlib
+import inspect
+import os
+
+import OpticalSystems as opsys
+
+default_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'array_cache')
+
+#every argument goes into the hash by value: arrays by dtype, shape and bytes,
+#containers element by element, numbers by their exact repr
+def _feed(h, value):
+    if isinstance(value, np.ndarray):
+        h.update(('ndarray' + str(value.dtype) + str(value.shape)).encode())
+        h.update(np.ascontiguousarray(value).data)
+    elif isinstance(value, (list, tuple)):
+        h.update((type(value).__name__ + str(len(value))).encode())
+        for v in value:
+            _feed(h, v)
+    elif isinstance(value, dict):
+        h.update(('dict' + str(len(value))).encode())
+        for k in sorted(value, key = repr):
+            _feed(h, k)
+            _feed(h, value[k])
+    elif value is None or isinstance(value, (bool, int, float, complex, str, bytes, np.generic)):
+        h.update(repr(value).encode())
+    else:
+        raise Warning('array_cache cannot hash a '+type(value).__name__)
+
+#Content addressed: the file of a call is <function>-<hash of the function's
+#source, its arguments(defaults filled in) and opsys.precision>.npy, so an
+#edited function or a changed argument is simply a different file(helpers it
+#calls are not part of the key, clear the folder after changing those).
+#Hits come back as read only memmaps. The folder is kept under max_bytes by
+#deleting the least recently used files, a hit touches its file's mtime, so
+#several processes(e.g. filter_sweep workers) can share one folder
+class ArrayCache:
+
+    def __init__(self, folder = default_folder, max_bytes = 4*2**30):
+        if max_bytes <= 0:
+            raise Warning('invalid max_bytes in ArrayCache')
+        self.folder = folder
+        self.max_bytes = max_bytes
+        os.makedirs(folder, exist_ok = True)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def key(self, function, *args, **kwargs):
+        arguments = inspect.signature(function).bind(*args, **kwargs)
+        arguments.apply_defaults()
+        h = hashlib.blake2b(digest_size = 20)
+        _feed(h, [function.__module__, function.__qualname__, inspect.getsource(function), \
+                  np.dtype(opsys.precision).name, dict(arguments.arguments)])
+        return function.__name__ + '-' + h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.folder, key + '.npy')
+
+    #-> the cached array(read only memmap) or None
+    def get(self, key):
+        path = self.path(key)
+        try:
+            array = np.load(path, mmap_mode = 'r')
+        except (FileNotFoundError, ValueError):
+            return None
+        os.utime(path)
+        self.bytes_read += os.path.getsize(path)
+        return array
+
+    #written next to its final name and renamed when complete, a reader never
+    #sees half an array. Arrays larger than max_bytes are not kept
+    def put(self, key, array):
+        array = np.asarray(array)
+        if array.dtype == object:
+            raise Warning('array_cache only stores numeric arrays')
+        if array.nbytes > self.max_bytes:
+            print('array cache: '+key+' is larger than max_bytes, not stored')
+            return
+        temporary = self.path(key) + '.' + str(os.getpid()) + '.tmp'
+        with open(temporary, 'wb') as f:
+            np.save(f, array)
+        os.replace(temporary, self.path(key))
+        self.bytes_written += os.path.getsize(self.path(key))
+        self.evict()
+
+    #oldest(least recently used) files first until the folder fits max_bytes
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.folder):
+            if name.endswith('.npy'):
+                try:
+                    stat = os.stat(os.path.join(self.folder, name))
+                except FileNotFoundError:
+                    continue #evicted by another process
+                entries.append((stat.st_mtime_ns, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.folder, name))
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    #function(*args, **kwargs), from the cache when it has been computed before.
+    #function must return one numeric array, which comes back read only either way
+    def call(self, function, *args, **kwargs):
+        key = self.key(function, *args, **kwargs)
+        array = self.get(key)
+        if array is not None:
+            self.hits += 1
+            return array
+        self.misses += 1
+        array = np.asarray(function(*args, **kwargs))
+        self.put(key, array)
+        array.setflags(write = False)
+        return array
+
+    #cached version of function, e.g. cache.wrap(opsys.accurate_filter_transmitance)
+    def wrap(self, function):
+        def _cached(*args, **kwargs):
+            return self.call(function, *args, **kwargs)
+        _cached.__name__ = function.__name__
+        return _cached
+
+    def size(self):
+        return sum(os.path.getsize(os.path.join(self.folder, name)) for name in os.listdir(self.folder) \
+                   if name.endswith('.npy'))
+
+    def report(self):
+        calls = self.hits + self.misses
+        print('array cache: '+str(self.hits)+' hits, '+str(self.misses)+' misses'\
+              +(' ('+'{:.0%}'.format(self.hits/calls)+' hit rate)' if calls else '')+', '\
+              +str(self.evictions)+' evicted, '+'{:.1f}'.format(self.bytes_read/2**20)+' MB read, '\
+              +'{:.1f}'.format(self.bytes_written/2**20)+' MB written, '\
+              +'{:.1f}'.format(self.size()/2**20)+' of '+'{:.1f}'.format(self.max_bytes/2**20)+' MB in use')
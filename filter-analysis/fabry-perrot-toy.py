@@ -6,7 +6,6 @@ Created on Tue Mar  9 11:13:34 2021
 """
 ##All units are in SI in base units, conversions are done just for plotting
 import numpy as np
-import matplotlib.pyplot as plt
 import scipy.signal as sci
 
 import sys
@@ -14,7 +13,21 @@ import os
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 import OpticalSystems as opsys
+from array_cache import ArrayCache
 
+#pyplot with every line decimated to screen resolution, opsys.set_headless()
+#skips the figures on a node without display(or saves them, given a folder)
+plt = opsys.pyplot
+
+#np.float32 halves the memory of every transmitance and convolution below,
+#precision_budget = True runs the error budget at the end, it says what that
+#costs in m/s(the realistic chain is rerun once per precision)
+opsys.set_precision(np.float64)
+precision_budget = False
+
+#the slow stages(realistic filter, convolutions) are kept on disk, a rerun with
+#the same parameters loads them instead of simulating again
+cache = ArrayCache()
 
 virtual_steps = 1000000 #just how many increments we want for some range of numbers
 lambda_target = 600e-9 #[m]
@@ -31,11 +44,12 @@ whitelight = opsys.white_light_generator(lambda_min, lambda_max, virtual_steps)
 
 filter_thickness = 2e-3#1e-3 #temporary, we would like to change this
 my_tilt = 2# +ve ->counter-clockwise tilt, -ve ->clockwise tilt
+realistic_filter = {'path_length': 43.718e-3, 'semi_diameter': 0.993e-3, 'n': 1.5, 'R1': 0.63947}
 
 transmitance_filter = opsys.filter_transmitance(whitelight, filter_thickness, \
                                            n = 1.5, percentage=0.05)
-accurate_transmitance_filter = opsys.accurate_filter_transmitance(whitelight, filter_thickness, path_length=43.718e-3,\
-                                                            semi_diameter=0.993e-3, n = 1.5, R1= 0.63947, tilt_deg= my_tilt)    
+accurate_transmitance_filter = cache.call(opsys.accurate_filter_transmitance, whitelight, filter_thickness, \
+                                          tilt_deg= my_tilt, **realistic_filter)
     
 plt.figure()
 #plt.plot(1e9*whitelight, transmitance_filter, label = 'Simplified Filter')
@@ -47,8 +61,6 @@ plt.ylabel("Transmitance")
 plt.grid()
 plt.show()
 
-del filter_thickness
-del my_tilt
 #%% fabry-perrot
 etalon_spacing = 7.6e-3 ##+/- 5e-7 m
 
@@ -65,7 +77,6 @@ plt.show()
 
 perfect_lambda = opsys.analytic_fabry_perot_peaks(lambda_min, lambda_max, etalon_spacing)
 
-del etalon_spacing
 #%%Neutral Density Filter
 
 #Assuming normal incidence, air->Ni-Fe
@@ -107,19 +118,15 @@ plt.ylabel("")
 plt.grid()
 plt.show()
 
-del gauss_cuttoff
-del gaussian_sample_space
 del dummy_x
 
 #%%Convolution
-pure_convolution = np.convolve(gauss, fabry_perot, mode = 'same')
-pure_convolution /= pure_convolution.max()
-
-simple_convolution = np.convolve(gauss, fabry_perot_filter, mode = 'same')
-simple_convolution /= simple_convolution.max()
-
-accurate_convolution = np.convolve(gauss, accurate_fabry_perot_filter, mode = 'same')
-accurate_convolution /= accurate_convolution.max()
+#all three systems share one gaussian, so it is transformed only once
+#(more kernels, e.g other gaussian_sample_space values, can be stacked in too)
+pure_convolution, simple_convolution, accurate_convolution = \
+    cache.call(opsys.batch_kernel_convolution, [gauss], [fabry_perot, fabry_perot_filter, \
+                                                         accurate_fabry_perot_filter])[:, 0]
+cache.report()
 
 fig, axs = plt.subplots(2, 1, sharex = 'all', sharey='all')
 axs[0].plot(1e9*whitelight, pure_convolution, color = 'r')
@@ -246,13 +253,11 @@ plt.show()
 #%%Discretisation
 wavelength_resolution = lambda_target/130000/3
 
-pure_discretized_convolution, pure_edges = opsys.discretize(whitelight, pure_convolution, \
-                                            wavelength_resolution, lambda_max, lambda_min)
-
-discretized_convolution, edges = opsys.discretize(whitelight, simple_convolution, \
-                                            wavelength_resolution, lambda_max, lambda_min)
-acc_discretized_convolution, acc_edges = opsys.discretize(whitelight, accurate_convolution, \
-                                            wavelength_resolution, lambda_max, lambda_min)
+#the three spectra share the whitelight grid, so they are binned together
+detector = opsys.DetectorBinning(whitelight, wavelength_resolution, lambda_max, lambda_min)
+pure_discretized_convolution, discretized_convolution, acc_discretized_convolution = \
+    detector(np.stack([pure_convolution, simple_convolution, accurate_convolution]))
+pure_edges = edges = acc_edges = detector.centres
 
 plt.figure()
 plt.plot(1e9*whitelight, pure_convolution)
@@ -289,7 +294,6 @@ plt.grid()
 plt.show()
 #plt.close()
 
-del wavelength_resolution
 #%%Gaussian fitting
 pure_disc_peaks = sci.find_peaks(pure_discretized_convolution)[0]
 pure_disc_valleys = sci.find_peaks(-pure_discretized_convolution)[0]
@@ -316,19 +320,19 @@ plt.plot(1e9*acc_edges[acc_disc_valleys], acc_discretized_convolution[acc_disc_v
 
 
         
-pure_gmeans, pure_gstd = opsys.gauss_model(pure_disc_peaks, pure_disc_valleys, pure_discretized_convolution, \
+pure_gmeans, pure_gstd = opsys.batch_gauss_model(pure_disc_peaks, pure_disc_valleys, pure_discretized_convolution, \
                                      pure_edges, vtol=0.05, show = True, perfect = perfect_lambda[1:-1])
-pure_gmeans_w, pure_gstd_w = opsys.gauss_model(pure_disc_peaks, pure_disc_valleys, pure_discretized_convolution, \
+pure_gmeans_w, pure_gstd_w = opsys.batch_gauss_model(pure_disc_peaks, pure_disc_valleys, pure_discretized_convolution, \
                                      pure_edges, vtol=0.05, show = True, perfect = perfect_lambda[1:-1], weights=1)
    
-gmeans, gstd = opsys.gauss_model(disc_peaks, disc_valleys, discretized_convolution, \
+gmeans, gstd = opsys.batch_gauss_model(disc_peaks, disc_valleys, discretized_convolution, \
                           edges, vtol = 0.05, show = True, perfect = perfect_lambda[1:-1])
-gmeans_w, gstd_w = opsys.gauss_model(disc_peaks, disc_valleys, discretized_convolution, \
+gmeans_w, gstd_w = opsys.batch_gauss_model(disc_peaks, disc_valleys, discretized_convolution, \
                           edges, vtol = 0.05, show = True, perfect = perfect_lambda[1:-1], weights=1)
 
-acc_gmean, acc_gstd = opsys.gauss_model(acc_disc_peaks, acc_disc_valleys, acc_discretized_convolution,\
+acc_gmean, acc_gstd = opsys.batch_gauss_model(acc_disc_peaks, acc_disc_valleys, acc_discretized_convolution,\
                                   acc_edges, vtol = 0.05, show = True, perfect = perfect_lambda[1:-1])
-acc_gmean_w, acc_gstd_w = opsys.gauss_model(acc_disc_peaks, acc_disc_valleys, acc_discretized_convolution,\
+acc_gmean_w, acc_gstd_w = opsys.batch_gauss_model(acc_disc_peaks, acc_disc_valleys, acc_discretized_convolution,\
                                   acc_edges, vtol = 0.05, show = True, perfect = perfect_lambda[1:-1], weights=1)
 del dummy
 #%%ERF model
@@ -339,18 +343,18 @@ del dummy
 
 #acc_gmean_erf = erf_model(acc_disc_peaks, acc_disc_valleys, acc_discretized_convolution, acc_edges, vtol = 0.2, show = True, perfect = perfect_lambda[1:-1])
 
-pure_gmeans_erf= opsys.erf_model(pure_disc_peaks, pure_disc_valleys, \
+pure_gmeans_erf= opsys.batch_erf_model(pure_disc_peaks, pure_disc_valleys, \
                                  pure_discretized_convolution, pure_edges,\
                                  pure_gmeans, pure_gstd, vtol = 0.3, \
                                  show = True, incr = increment)
     
-pure_gmeans_erf_w = opsys.erf_model(pure_disc_peaks, pure_disc_valleys, \
+pure_gmeans_erf_w = opsys.batch_erf_model(pure_disc_peaks, pure_disc_valleys, \
                                     pure_discretized_convolution, pure_edges,\
                                     pure_gmeans_w, pure_gstd_w, vtol = 0.3, \
                                     show = True, weights=1, incr = increment)
     
 
-acc_gmean_erf_w = opsys.erf_model(acc_disc_peaks, acc_disc_valleys, \
+acc_gmean_erf_w = opsys.batch_erf_model(acc_disc_peaks, acc_disc_valleys, \
                                   acc_discretized_convolution, acc_edges,\
                                   acc_gmean_w, acc_gstd_w, vtol = 0.3, \
                                   show = True, weights=1, incr = increment)
@@ -589,4 +593,24 @@ plt.title("Error between Fabry-Perot and discretized Fabry-Perot, erf fit")
 plt.xlabel("Wavelength [nm]")
 plt.ylabel("Error in speed[m/s]")
 plt.grid()
-plt.show()
\ No newline at end of file
+plt.show()
+
+#%%float32 error budget, radial speed shift of every gaussian and erf peak of
+#the realistic chain against float64. The parameters are those of the toy
+#above, the filter and convolution go through the array cache(keyed by precision)
+def realistic_chain():
+    light = opsys.white_light_generator(lambda_min, lambda_max, virtual_steps)
+    system = opsys.fabry_perot_transmitance(light, etalon_spacing)*\
+        cache.call(opsys.accurate_filter_transmitance, light, filter_thickness, tilt_deg= my_tilt, **realistic_filter)
+    kernel, _ = opsys.gaussian(gauss_cuttoff, gaussian_sample_space, lambda_target, lambda_max, lambda_min, \
+                               virtual_steps)
+    convolution = cache.call(opsys.kernel_convolution, kernel, system)
+    pixels, centres = opsys.discretize(light, convolution, wavelength_resolution, lambda_max, lambda_min)
+    valleys = sci.find_peaks(-pixels)[0]
+    means, stds = opsys.batch_gauss_model(None, valleys, pixels, centres, vtol = 0.05, show = False)
+    erf_means = opsys.batch_erf_model(None, valleys, pixels, centres, means, stds, increment, vtol = 0.3, \
+                                      show = False)
+    return {'gauss': means, 'erf': erf_means}
+
+if precision_budget:
+    precision_speed_shift = opsys.precision_error_budget(realistic_chain)
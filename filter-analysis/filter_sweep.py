@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Sweep of the fabry-perrot-toy study over filter type, tilt, estimator and fit
+weight, one task_pool task per (filter, tilt).
+
+@author: User
+"""
+import numpy as np
+import scipy.signal as sci
+import itertools
+
+from tqdm import tqdm
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import OpticalSystems as opsys
+import instrumentation
+import task_pool
+
+c = 3e8
+
+#the defaults of fabry-perrot-toy. filters holds the accurate_filter_transmitance
+#arguments of every tilted filter: 'infrared' is the 800FL07-12.5 data sheet
+#model, 'realistic' the toy's "Realistic Filter"(the same model with its
+#strongly reflecting coating and geometry). 'simple'(filter_transmitance),
+#'neutral_density'(opsys.neutral_density at normal incidence, air->Ni-Fe as in
+#the toy, no cone to tilt) and 'none'(the bare Fabry-Perot) are always there
+#and ignore the tilt
+default_parameters = {'virtual_steps': 1000000, #just how many increments we want for some range of numbers
+                      'lambda_target': 600e-9,
+                      'lambda_deviation': 0.3e-9,
+                      'etalon_spacing': 7.6e-3, ##+/- 5e-7 m
+                      'gaussian_sample_space': 130000,
+                      'gauss_cuttoff': 0.001, #the percentage height at which ignore the rest of the gaussian
+                      'pixels_per_resolution': 3,
+                      'filter_thickness': 2e-3,
+                      'gauss_vtol': 0.05,
+                      'erf_vtol': 0.3,
+                      'filters': {'infrared': {'n': 1.5},
+                                  'realistic': {'path_length': 43.718e-3, 'semi_diameter': 0.993e-3,\
+                                                'n': 1.5, 'R1': 0.63947}},
+                      'neutral_density_R1': abs((1-2.2714)/(1+2.2714))**2}
+
+#every combination of these is one grid point, weights as in batch_gauss_model
+default_grid = {'filter': ['infrared', 'realistic', 'neutral_density'],
+                'tilt': [0, 2], # +ve ->counter-clockwise tilt, -ve ->clockwise tilt
+                'estimator': ['gauss', 'erf'],
+                'weight': [0, 1]}
+
+#one row per fitted peak of every grid point, radial_speed = c*(fit - perfect)/perfect
+#[m/s], tilt is nan for the filters that have none
+table_dtype = [('filter', 'U32'), ('tilt', float), ('estimator', 'U8'), ('weight', int), \
+               ('peak', int), ('perfect_lambda', float), ('fit_lambda', float), ('radial_speed', float)]
+
+#whatever every grid point has in common: the wavelength grid, the bare
+#Fabry-Perot, its analytic peaks, the gaussian kernel and the detector bins
+def shared_system(parameters = default_parameters):
+    lambda_min = parameters['lambda_target'] - parameters['lambda_deviation']
+    lambda_max = parameters['lambda_target'] + parameters['lambda_deviation']
+    steps = parameters['virtual_steps']
+    whitelight = opsys.white_light_generator(lambda_min, lambda_max, steps)
+    gauss, _ = opsys.gaussian(parameters['gauss_cuttoff'], parameters['gaussian_sample_space'], \
+                              parameters['lambda_target'], lambda_max, lambda_min, steps)
+    resolution = parameters['lambda_target']/parameters['gaussian_sample_space']/parameters['pixels_per_resolution']
+    return {'whitelight': whitelight,
+            'increment': (lambda_max - lambda_min)/steps,
+            'fabry_perot': opsys.fabry_perot_transmitance(whitelight, parameters['etalon_spacing']),
+            'perfect_lambda': opsys.analytic_fabry_perot_peaks(lambda_min, lambda_max, parameters['etalon_spacing']),
+            'gauss': gauss,
+            'detector': opsys.DetectorBinning(whitelight, resolution, lambda_max, lambda_min)}
+
+def filter_transmitance(shared, filter_type, tilt, parameters = default_parameters):
+    whitelight = shared['whitelight']
+    if filter_type == 'none':
+        return None
+    if filter_type == 'simple':
+        return opsys.filter_transmitance(whitelight, parameters['filter_thickness'], n = 1.5, percentage = 0.05)
+    if filter_type == 'neutral_density':
+        return opsys.neutral_density(whitelight, parameters['neutral_density_R1'], parameters['filter_thickness'])
+    if filter_type not in parameters['filters']:
+        raise Warning('unknown filter '+str(filter_type)+' in filter_sweep')
+    return opsys.accurate_filter_transmitance(whitelight, parameters['filter_thickness'], tilt_deg = tilt,\
+                                              **parameters['filters'][filter_type])
+
+def is_tilted(filter_type):
+    return filter_type not in ['none', 'simple', 'neutral_density']
+
+#index of the nearest perfect_lambda(ascending) of every fitted peak
+def nearest_peak(means, perfect_lambda):
+    means = np.asarray(means)
+    nearest = np.clip(np.searchsorted(perfect_lambda, means), 1, len(perfect_lambda) - 1)
+    nearest -= np.abs(means - perfect_lambda[nearest - 1]) < np.abs(means - perfect_lambda[nearest])
+    return nearest
+
+#everything of one (filter, tilt), tilt is None for the untilted filters: the
+#system is convolved and discretized once, then every estimator/weight pair
+#is fitted on the same pixels(erf starts from the gaussian fit of its own
+#weight, as in the toy)
+@instrumentation.stage
+def filter_point(shared, filter_type, tilt, estimators, weights, parameters = default_parameters):
+    transmitance = filter_transmitance(shared, filter_type, tilt, parameters)
+    system = shared['fabry_perot'] if transmitance is None else shared['fabry_perot']*transmitance
+    convolution = opsys.kernel_convolution(shared['gauss'], system)
+    pixels = shared['detector'](convolution)
+    edges = shared['detector'].centres
+    valleys = sci.find_peaks(-pixels)[0]
+    perfect_lambda = shared['perfect_lambda']
+
+    rows = []
+    for weight in weights:
+        gmeans, gstd = opsys.batch_gauss_model(None, valleys, pixels, edges, vtol = parameters['gauss_vtol'], \
+                                               show = False, weights = weight)
+        for estimator in estimators:
+            if estimator == 'gauss':
+                means = np.array(gmeans)
+            elif estimator == 'erf':
+                means = np.array(opsys.batch_erf_model(None, valleys, pixels, edges, gmeans, gstd, \
+                                                       shared['increment'], vtol = parameters['erf_vtol'], \
+                                                       show = False, weights = weight))
+            else:
+                raise Warning('unknown estimator '+str(estimator)+' in filter_sweep')
+            peak = nearest_peak(means, perfect_lambda)
+            speed = c*(means - perfect_lambda[peak])/perfect_lambda[peak]
+            rows += [(filter_type, np.nan if tilt is None else tilt, estimator, weight, p, perfect_lambda[p], m, s) \
+                     for p, m, s in zip(peak, means, speed)]
+    return rows
+
+#the workers build nothing themselves, the shared system comes with the pool
+_shared = None
+
+def _init_worker(shared):
+    global _shared
+    _shared = shared
+
+def _point_task(task):
+    key, estimators, weights, parameters, instrumented = task
+    rows, records = instrumentation.run_task(instrumented, key, filter_point, _shared, *key, estimators, \
+                                             weights, parameters)
+    return key, rows, records
+
+#runs every combination of grid(lists of 'filter', 'tilt', 'estimator' and
+#'weight') and returns the table(a structured array of table_dtype), grouped
+#by (filter, tilt) in grid order. shared_system is computed once(pass shared to reuse it
+#across sweeps), every (filter, tilt) is one task and n_workers > 1 spreads
+#them over a process pool; untilted filters are computed once, whatever the tilts
+def sweep(grid = default_grid, parameters = default_parameters, n_workers = 1, shared = None):
+    if n_workers < 1:
+        raise Warning('invalid n_workers in sweep')
+    if shared is None:
+        shared = shared_system(parameters)
+
+    keys = list(dict.fromkeys((filter_type, float(tilt) if is_tilted(filter_type) else None) \
+                              for filter_type, tilt in itertools.product(grid['filter'], grid['tilt'])))
+    tasks = [(key, list(grid['estimator']), list(grid['weight']), parameters, instrumentation.settings()) \
+             for key in keys]
+
+    results = task_pool.run_tasks(_point_task, tasks, n_workers, initializer = _init_worker, initargs = (shared,))
+    points = {}
+    try:
+        for key, rows, records in tqdm(results, total = len(tasks)):
+            points[key] = rows
+            instrumentation.merge(records)
+    finally:
+        results.close()
+
+    return np.array([row for key in keys for row in points[key]], dtype = table_dtype)
+
+#rows of table where every column equals the given value(nan matches nan), e.g.
+#select(table, filter = 'infrared', estimator = 'erf')
+def select(table, **columns):
+    keep = np.ones(len(table), dtype = bool)
+    for name, value in columns.items():
+        if isinstance(value, float) and np.isnan(value):
+            keep &= np.isnan(table[name])
+        else:
+            keep &= table[name] == value
+    return table[keep]
+
+def export(table, path):
+    np.savetxt(path, table, delimiter = ',', header = ','.join(table.dtype.names), comments = '', \
+               fmt = ['%s', '%.6g', '%s', '%d', '%d', '%.16e', '%.16e', '%.9e'])
+
+#%%the default grid, one radial speed curve per grid point
+if __name__ == '__main__':
+    plt = opsys.pyplot
+
+    table = sweep(n_workers = os.cpu_count())
+    export(table, 'filter_sweep.csv')
+
+    for filter_type in default_grid['filter']:
+        plt.figure()
+        for tilt, estimator, weight in itertools.product(default_grid['tilt'], default_grid['estimator'], \
+                                                         default_grid['weight']):
+            rows = select(table, filter = filter_type, tilt = tilt, estimator = estimator, weight = weight)
+            plt.plot(1e9*rows['perfect_lambda'], rows['radial_speed'], \
+                     label = estimator+', weight '+str(weight)+', tilt '+str(tilt))
+        plt.legend()
+        plt.title("Radial speed of Fabry-Perot + "+filter_type+" filter")
+        plt.xlabel("Wavelength [nm]")
+        plt.ylabel("Error in speed[m/s]")
+        plt.grid()
+        plt.show()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+The fabry-perrot-toy chain over the whole 380-788nm band, at the same
+sampling, streamed chunk by chunk(opsys.stream_band)
+"""
+##All units are in SI in base units, conversions are done just for plotting
+import numpy as np
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import OpticalSystems as opsys
+plt = opsys.pyplot
+
+#same sampling as the toy, 0.6nm in 1e6 steps
+increment = 0.6e-9/1000000
+lambda_target = 600e-9 #[m] where the resolution is defined
+lambda_min = 380e-9
+lambda_max = 788e-9
+etalon_spacing = 7.6e-3
+
+def transmitance(lambda_range):
+    return opsys.fabry_perot_transmitance(lambda_range, etalon_spacing)*\
+        opsys.filter_transmitance(lambda_range, 2e-3, n = 1.5, percentage = 0.05)
+
+gauss, _ = opsys.gaussian(0.001, 130000, lambda_target, lambda_target + 0.3e-9, \
+                          lambda_target - 0.3e-9, 1000000)
+wavelength_resolution = lambda_target/130000/3
+
+#%%the run, only the pixels and peaks are kept
+pixel_centres, pixels, means = [], [], []
+for centres, chunk_pixels, peaks in opsys.stream_band(transmitance, gauss, lambda_min, lambda_max, \
+                                                       increment, wavelength_resolution, vtol = 0.05):
+    pixel_centres.append(centres)
+    pixels.append(chunk_pixels)
+    means.append(peaks)
+pixel_centres = np.concatenate(pixel_centres)
+pixels = np.concatenate(pixels)
+means = np.concatenate(means)
+
+#%%radial speed error against the nearest analytic peak
+c = 3e8
+perfect_lambda = opsys.analytic_fabry_perot_peaks(lambda_min, lambda_max, etalon_spacing)
+nearest = np.clip(np.searchsorted(perfect_lambda, means), 1, len(perfect_lambda) - 1)
+nearest -= np.abs(means - perfect_lambda[nearest - 1]) < np.abs(means - perfect_lambda[nearest])
+reference = perfect_lambda[nearest]
+speed_error = c*(means - reference)/reference
+
+plt.figure()
+plt.plot(1e9*pixel_centres, pixels)
+plt.title("Discretized Fabry-Perot + simple filter, full band")
+plt.xlabel("Wavelength [nm]")
+plt.ylabel("Transmitance")
+plt.grid()
+plt.show()
+
+plt.figure()
+plt.plot(1e9*reference, speed_error)
+plt.title("Error between Fabry-Perot and discretized Fabry-Perot, guaussian fit, full band")
+plt.xlabel("Wavelength [nm]")
+plt.ylabel("Error in speed[m/s]")
+plt.grid()
+plt.show()
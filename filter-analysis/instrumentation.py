@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in timing and memory records of the pipeline stages(OpticalSystems and
+the PSF scripts), per stage and per configuration, reported as json lines.
+
+    instrumentation.enable('run.jsonl')   #or OPSYS_INSTRUMENT=run.jsonl
+    ... the run ...
+    instrumentation.report()              #also done at exit once enabled
+
+@author: User
+"""
+import atexit
+import functools
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError: #windows, no peak RSS
+    resource = None
+
+enabled = False
+trace_allocations = False
+report_path = None
+
+_records = []
+_unreported = False #records made since the last report()
+_stack = []
+_config = None
+_started = None
+
+#ru_maxrss is in kB on linux and in bytes on macos
+def peak_rss():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss*1024
+
+#allocations = True also follows the python/numpy allocations with tracemalloc
+#(peak and retained bytes of every stage), which slows python heavy stages down.
+#The report is written to path at exit
+def enable(path = None, allocations = False):
+    global enabled, trace_allocations, report_path, _started
+    enabled = True
+    trace_allocations = allocations
+    report_path = path
+    if _started is None:
+        _started = (time.time(), time.perf_counter(), time.process_time())
+    if allocations and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def disable():
+    global enabled
+    enabled = False
+    if trace_allocations and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+#every record made inside is labelled with this configuration, e.g. the
+#ordered_data index of a kernel_sweep cell
+class config:
+
+    def __init__(self, label):
+        self.label = label
+
+    def __enter__(self):
+        global _config
+        self.previous, _config = _config, self.label
+        return self
+
+    def __exit__(self, *exc):
+        global _config
+        _config = self.previous
+        return False
+
+#one stage: wall and cpu time, the time spent in its own code(self_wall_s,
+#nested stages excluded), the tracemalloc peak above what was allocated when it
+#started and what it left allocated, and the process peak RSS when it ended
+class measure:
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if not enabled:
+            self.active = False
+            return self
+        self.active = True
+        self.children = 0.
+        if trace_allocations and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            if _stack:
+                _stack[-1].peak = max(_stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+            self.traced, self.peak = current, current
+        _stack.append(self)
+        self.wall, self.cpu = time.perf_counter(), time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        global _unreported
+        if not self.active:
+            return False
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        _stack.pop()
+        record = {'config': _config, 'stage': self.name, 'wall_s': wall, 'self_wall_s': wall - self.children, \
+                  'cpu_s': cpu, 'rss_peak_bytes': peak_rss()}
+        if trace_allocations and tracemalloc.is_tracing():
+            current, peak = tracemalloc.get_traced_memory()
+            self.peak = max(self.peak, peak)
+            record['allocated_peak_bytes'] = self.peak - self.traced
+            record['retained_bytes'] = current - self.traced
+            if _stack:
+                _stack[-1].peak = max(_stack[-1].peak, self.peak)
+            tracemalloc.reset_peak()
+        if _stack:
+            _stack[-1].children += wall
+        _records.append(record)
+        _unreported = True
+        return False
+
+#decorator, the stage is named after the function. Disabled it costs one check
+def stage(function):
+    name = function.__qualname__
+    @functools.wraps(function)
+    def _measured(*args, **kwargs):
+        if not enabled:
+            return function(*args, **kwargs)
+        with measure(name):
+            return function(*args, **kwargs)
+    return _measured
+
+def record_count():
+    return len(_records)
+
+#the records from index since(an earlier record_count()) on, removed from this
+#process: a pool task sends back only its own, not those a forked worker inherited
+def take_records(since = 0):
+    records = _records[since:]
+    del _records[since:]
+    return records
+
+def merge(records):
+    global _unreported
+    _records.extend(records)
+    _unreported = _unreported or bool(records)
+
+#what a pool task needs to be instrumented like its parent
+def settings():
+    return enabled, trace_allocations
+
+#function(*args) of one pool task labelled with config label -> (result, the
+#records it made). A spawned worker starts disabled and is enabled from
+#settings, the parent merges the records
+def run_task(settings, label, function, *args):
+    if settings[0] and not enabled:
+        enable(allocations = settings[1])
+    since = record_count()
+    with config(label):
+        result = function(*args)
+    return result, take_records(since)
+
+#(config, stage) totals, calls and times summed, memory at its maximum
+def _aggregate(records, by_config = True):
+    totals = {}
+    for r in records:
+        key = (r['config'] if by_config else None, r['stage'])
+        if key not in totals:
+            totals[key] = {'config': key[0], 'stage': key[1], 'calls': 0, 'wall_s': 0., 'self_wall_s': 0., \
+                           'cpu_s': 0., 'rss_peak_bytes': None}
+        t = totals[key]
+        t['calls'] += 1
+        for k in ['wall_s', 'self_wall_s', 'cpu_s']:
+            t[k] += r[k]
+        if r['rss_peak_bytes'] is not None:
+            t['rss_peak_bytes'] = max(t['rss_peak_bytes'] or 0, r['rss_peak_bytes'])
+        if 'allocated_peak_bytes' in r:
+            t['allocated_peak_bytes'] = max(t.get('allocated_peak_bytes', 0), r['allocated_peak_bytes'])
+            t['retained_bytes'] = t.get('retained_bytes', 0) + r['retained_bytes']
+    return sorted(totals.values(), key = lambda t: -t['self_wall_s'])
+
+#json lines: one 'run' line, one 'stage' line per (config, stage) and one
+#'summary' line per stage over all configs, slowest(self time) first. The
+#summary is also printed. At exit it is only written again if records were
+#made after the last call
+def report(path = None):
+    global _unreported
+    _unreported = False
+    path = report_path if path is None else path
+    summary = _aggregate(_records, by_config = False)
+    wall = time.perf_counter() - _started[1] if _started else None
+    cpu = time.process_time() - _started[2] if _started else None
+
+    print('stage'.ljust(40)+'calls'.rjust(8)+'self [s]'.rjust(12)+'total [s]'.rjust(12)+'cpu [s]'.rjust(12))
+    for t in summary:
+        print(t['stage'][:40].ljust(40)+str(t['calls']).rjust(8)+'{:.3f}'.format(t['self_wall_s']).rjust(12)\
+              +'{:.3f}'.format(t['wall_s']).rjust(12)+'{:.3f}'.format(t['cpu_s']).rjust(12))
+    if path is None:
+        return summary
+
+    with open(path, 'w') as f:
+        f.write(json.dumps({'type': 'run', 'started': _started[0] if _started else None, 'wall_s': wall, \
+                            'cpu_s': cpu, 'rss_peak_bytes': peak_rss(), 'allocations': trace_allocations, \
+                            'argv': sys.argv}) + '\n')
+        for t in _aggregate(_records):
+            f.write(json.dumps(dict(type = 'stage', **t)) + '\n')
+        for t in summary:
+            t = dict(t)
+            del t['config']
+            f.write(json.dumps(dict(type = 'summary', **t)) + '\n')
+    print('instrumentation report written to '+path)
+    return summary
+
+def _report_at_exit():
+    if enabled and _unreported and report_path is not None:
+        report()
+
+atexit.register(_report_at_exit)
+
+#OPSYS_INSTRUMENT=path[,allocations] turns it on without touching the scripts
+if os.environ.get('OPSYS_INSTRUMENT') and not enabled:
+    _setting = os.environ['OPSYS_INSTRUMENT'].split(',')
+    enable(_setting[0], allocations = 'allocations' in _setting[1:])
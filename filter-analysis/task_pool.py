@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+The process pool of the sweeps(filter_sweep, psf-analysis/kernel_sweep): one
+function over a list of tasks, in this process or spread over workers.
+
+@author: User
+"""
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+#fork where the platform has it, workers then share the parent's memory. With
+#spawn(windows) the calling script must guard the sweep with __name__ == '__main__'
+def pool_context():
+    if 'fork' in mp.get_all_start_methods():
+        return mp.get_context('fork')
+    return mp.get_context('spawn')
+
+#function(task) of every task -> generator of the results, in task order with
+#n_workers = 1(initializer(*initargs) is then run here), in completion order
+#on a pool otherwise, so results should carry their task. function and the
+#tasks must pickle and the module of function must import without side effects.
+#Closing the generator(or an exception in the loop over it) cancels the
+#tasks not started yet
+def run_tasks(function, tasks, n_workers = 1, initializer = None, initargs = ()):
+    if n_workers < 1:
+        raise Warning('invalid n_workers in run_tasks')
+    if n_workers == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for task in tasks:
+            yield function(task)
+        return
+
+    executor = ProcessPoolExecutor(max_workers = n_workers, mp_context = pool_context(), \
+                                   initializer = initializer, initargs = initargs)
+    try:
+        for future in as_completed([executor.submit(function, task) for task in tasks]):
+            yield future.result()
+    finally:
+        executor.shutdown(cancel_futures = True)
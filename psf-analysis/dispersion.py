@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""
+Dispersion laws of the orders, wavelength as a function of the detector x,
+fitted for all orders at once and with the inverse x(wavelength).
+
+@author: User
+"""
+import numpy as np
+import numpy.polynomial.chebyshev as cheb
+
+#chebyshev series sum_k coefficients[k]*T_k(t), coefficients[k] broadcasts against t
+def _clenshaw(t, coefficients):
+    b1 = np.zeros_like(t)
+    b2 = np.zeros_like(t)
+    for c in coefficients[:0:-1]:
+        b1, b2 = 2*t*b1 - b2 + c, b1
+    return t*b1 - b2 + coefficients[0]
+
+#wavelength [um] = law(x [mm]) for every order. x and wavelength are
+#(n_orders, n_points) arrays, row j being order j+1. Each order is mapped onto
+#[-1, 1] and fitted in the chebyshev basis, which unlike 8th degree monomials
+#in mm stays well conditioned. The inverse uses a table of inverse_samples
+#points per order polished by newton steps
+class DispersionModel:
+
+    def __init__(self, x, wavelength, degree = 8, inverse_samples = 4096):
+        x = np.asarray(x, dtype = float)
+        wavelength = np.asarray(wavelength, dtype = float)
+        if x.ndim != 2 or x.shape != wavelength.shape:
+            raise Warning('DispersionModel needs (orders, points) arrays of x and wavelength')
+        if x.shape[1] <= degree:
+            raise Warning('a degree '+str(degree)+' law needs more than '+str(degree)+' points per order')
+        self.degree = degree
+        self.n_orders = x.shape[0]
+
+        self.x_min = x.min(axis = 1)
+        self.x_max = x.max(axis = 1)
+        self.center = (self.x_max + self.x_min)/2
+        self.half_width = (self.x_max - self.x_min)/2
+
+        #one least squares solve for every order, through a stacked QR
+        basis = cheb.chebvander((x - self.center[:, None])/self.half_width[:, None], degree)
+        q, r = np.linalg.qr(basis)
+        self.coefficients = np.linalg.solve(r, np.swapaxes(q, -1, -2) @ wavelength[..., None])[..., 0]
+        #d(wavelength)/dx [um/mm]
+        self.slope_coefficients = cheb.chebder(self.coefficients, axis = 1)/self.half_width[:, None]
+        self.residuals = wavelength - self(x, np.arange(1, self.n_orders + 1)[:, None])
+
+        #the inverse tables, stored with increasing wavelength
+        self._table_x = np.linspace(self.x_min, self.x_max, inverse_samples, axis = 1)
+        self._table_w = self(self._table_x, np.arange(1, self.n_orders + 1)[:, None])
+        steps = np.diff(self._table_w, axis = 1)
+        for j in range(self.n_orders):
+            if np.all(steps[j] < 0):
+                self._table_x[j] = self._table_x[j][::-1]
+                self._table_w[j] = self._table_w[j][::-1]
+            elif not np.all(steps[j] > 0):
+                raise Warning('the dispersion law of order '+str(j+1)+' is not monotonic, it has no inverse')
+
+    #rows of RayTrace_Iterate.txt(ORDER---WAVELENGTH(um)---XPOS(mm)---YPOS(mm))
+    @classmethod
+    def from_raytrace(cls, rows, degree = 8, inverse_samples = 4096):
+        orders = np.unique(rows[:, 0])
+        if not np.array_equal(orders, np.arange(1, len(orders) + 1)):
+            raise Warning('the ray trace orders are not numbered 1 to '+str(len(orders)))
+        per_order = [rows[rows[:, 0] == order] for order in orders]
+        if len(set(len(r) for r in per_order)) != 1:
+            raise Warning('the orders do not have the same number of ray traced points')
+        return cls(np.array([r[:, 2] for r in per_order]), np.array([r[:, 1] for r in per_order]),\
+                   degree, inverse_samples)
+
+    def _index(self, order):
+        index = np.asarray(order, dtype = int) - 1
+        if np.any(index < 0) or np.any(index >= self.n_orders):
+            raise Warning('orders go from 1 to '+str(self.n_orders))
+        return index
+
+    #order is a number or an array broadcasting against x
+    def __call__(self, x, order):
+        index = self._index(order)
+        t = (np.asarray(x, dtype = float) - self.center[index])/self.half_width[index]
+        return _clenshaw(t, np.moveaxis(self.coefficients[index], -1, 0))
+
+    #d(wavelength)/dx [um/mm]
+    def slope(self, x, order):
+        index = self._index(order)
+        t = (np.asarray(x, dtype = float) - self.center[index])/self.half_width[index]
+        return _clenshaw(t, np.moveaxis(self.slope_coefficients[index], -1, 0))
+
+    #wavelength [um] -> x [mm], nan where the wavelength is outside the order
+    def inverse(self, wavelength, order, newton_steps = 1):
+        wavelength = np.asarray(wavelength, dtype = float)
+        index = self._index(order)
+        if index.ndim == 0:
+            x = np.interp(wavelength, self._table_w[index], self._table_x[index], left = np.nan, right = np.nan)
+        else:
+            index, wavelength = np.broadcast_arrays(index, wavelength)
+            x = np.empty(wavelength.shape)
+            for j in np.unique(index):
+                here = index == j
+                x[here] = np.interp(wavelength[here], self._table_w[j], self._table_x[j], left = np.nan, right = np.nan)
+        for _ in range(newton_steps):
+            x -= (self(x, index + 1) - wavelength)/self.slope(x, index + 1)
+        return x
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+Per configuration pipeline of fabry-perrot-toy-kernel-compare, free of any
+module level work so that worker processes can import it.
+
+@author: User
+"""
+import numpy as np
+import scipy.interpolate as interp
+import scipy.signal as sci
+
+from tqdm import tqdm
+import functools
+import json
+import os
+import sys
+
+#the optical system functions live with the filter analysis
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'filter-analysis'))
+import OpticalSystems as opsys
+import instrumentation
+import task_pool
+import psf_analyzer as PSF
+import psf_cache
+
+c = 3e8
+
+#the defaults of the kernel-compare study
+default_parameters = {'virtual_steps': 1000000, #just how many increments we want for some range of numbers
+                      'gaussian_sample_space': 130000,
+                      'gauss_cuttoff': 0.001, #the percentage height at which ignore the rest of the gaussian
+                      'etalon_spacing': 7.6e-3, ##+/- 5e-7 m
+                      'F': 10000} #finesse coefficient of the laser comb
+
+def peakfinder(signal, axis):#signal and axis MUST be the same dimenstion and correspond to eachother(order matters)
+    peak_idx = sci.find_peaks(signal)[0]
+    axis_values_of_peaks = axis[peak_idx]
+    return axis_values_of_peaks
+
+def peak_allignment(sample, reference):
+    global c
+    aligned_peaks = sample - reference
+    aligned_peaks /= reference
+    aligned_peaks *= c
+    return aligned_peaks
+
+def reject_false_peaks(array1, array2):#tol is the tolerance below which we reject a peak
+
+    temp1 = array1
+    temp2 = array2
+    #tol = 5e-11 #this is very arbitrary and happens to work in this application
+    # temp = []
+
+    # for i in range(len(temp1)-1):
+    #     if (temp1[i+1] - temp1[i])
+
+    a = temp1[0] - temp2[0]
+    b = temp1[-1] - temp2[-1]
+    if abs(a) > abs(b):
+        if a > 0:
+            return[temp1, temp2[1:]]
+        else:
+            return[temp1[1:], temp2]
+    else:
+        if b > 0:
+            return[temp1[0:-1], temp2]
+        else:
+            return[temp1, temp2[0:-1]]
+
+def median_span(array, below = 0, above = 0):
+    medianspan = []
+    temp = []
+
+    n = len(array)
+
+    if n%2 == 1:
+        temp = array
+        n = (n+1)/2
+    else:
+        counter = 0
+        while(counter < n - 1):
+            temp2 = (array[counter] + array[counter + 1])/2
+            temp.append(temp2)
+            counter += 1
+
+        n = n/2
+
+    n = int(n) -1#python indexing starts at 0, not 1(so we sub 1)
+    counter = n - below
+    while(counter <= n + above):
+        medianspan.append(temp[counter])
+        counter += 1
+
+    return medianspan
+
+#one entry of psf_analyzer.ordered_data -> the averaged radial speed of its
+#center 3 peaks. plot is an optional plotter_function(xvalues, yvalues, title,
+#xlabel, ylabel, labels) for debugging single configurations.
+#With parameters['windowed'] = True only windows around the analytic peaks are
+#convolved(opsys.windowed_peaks) and the peaks are sub-sample, the dense grid
+#and its plots are skipped
+@instrumentation.stage
+def config_misalignment(entry, parameters = default_parameters, plot = None):
+    virtual_steps = parameters['virtual_steps']
+    etalon_spacing = parameters['etalon_spacing']
+
+    wtest = entry[1]
+    xtest = entry[2]
+    ytest = entry[3]
+
+    wtest_string = str(round(1e9*wtest, 0))
+
+    if plot: plot(xtest, ytest, "True Kernel(Not normalised) @ "+wtest_string+" nm", "Centered wavelength [nm]")
+
+    lambda_target = wtest #[m]
+    lambda_deviation = 0.0005*wtest#0.3e-9 #[m]this varies depending on application    0.3e-9
+
+    lambda_min = lambda_target - lambda_deviation
+    lambda_max = lambda_target + lambda_deviation
+
+    gauss, dummy_x = opsys.gaussian(parameters['gauss_cuttoff'], parameters['gaussian_sample_space'], \
+                                    lambda_target, lambda_max, lambda_min, virtual_steps)
+
+    if plot: plot([1e9*(dummy_x + wtest), 1e9*xtest], [gauss, ytest],\
+                  title = "Unit Gaussian(Not normalised) @ "+wtest_string+" nm",\
+                  xlabel = "Centered wavelength [nm]")
+
+    f = interp.interp1d(xtest, ytest)
+    compatible_res_axis = dummy_x + wtest
+    #interpolating the new gaussian in order to compensate for the different resolution
+    true_kernel = f(compatible_res_axis)
+
+    if parameters.get('windowed', False):
+        increment = (lambda_max - lambda_min)/virtual_steps
+        expected_peaks = opsys.analytic_fabry_perot_peaks(lambda_min, lambda_max, etalon_spacing)
+        ideal_peaks, _, _ = opsys.windowed_peaks(lambda l: opsys.fabry_perot_transmitance(l, etalon_spacing), \
+                                                 true_kernel, expected_peaks, lambda_min, increment)
+        true_peaks, _, _ = opsys.windowed_peaks(lambda l: opsys.fabry_perot_transmitance(l, etalon_spacing, F = parameters['F']), \
+                                                true_kernel, expected_peaks, lambda_min, increment)
+        return np.mean(median_span(peak_allignment(true_peaks, ideal_peaks),1,1))
+
+    whitelight = opsys.white_light_generator(lambda_min, lambda_max, virtual_steps)
+
+    #this also acts as the reference transmitance, not just for composing systems
+    fabry_perot = opsys.fabry_perot_transmitance(whitelight, etalon_spacing)
+
+    laser_comb = opsys.fabry_perot_transmitance(whitelight, etalon_spacing, F = parameters['F'])
+
+    if plot:
+        plot(1e9*whitelight, fabry_perot, \
+             title = "Transmitance of the Fabry-Perot @ "+wtest_string+" nm",\
+             ylabel = "Transmitance", xlabel = "Wavelength [nm]")
+        plot(1e9*whitelight, laser_comb, \
+             title = "Transmitance of the Laser-Comb @ "+wtest_string+" nm",\
+             ylabel = "Transmitance", xlabel = "Wavelength [nm]")
+
+    fb_convolution, las_convolution = \
+        opsys.batch_kernel_convolution([true_kernel], [fabry_perot, laser_comb])[:, 0]
+
+    if plot: plot([1e9*whitelight,1e9*whitelight],[fb_convolution, las_convolution],\
+                  labels = ['Fabry-Perot convolution','Laser-Comb convolution'],\
+                  xlabel="Wavelength [nm]", ylabel = "Transmitance", \
+                  title = "Resultant convolutions @ "+wtest_string+" nm")
+
+    #finding the peaks and alligning them(we reject the extrema due to convolutionnuisances)
+    ideal_peaks = peakfinder(fb_convolution, whitelight)
+    true_peaks = peakfinder(las_convolution, whitelight)
+
+    if ideal_peaks.size != true_peaks.size:
+        ideal_peaks, true_peaks = reject_false_peaks(ideal_peaks, true_peaks)
+    misalignment = peak_allignment(true_peaks, ideal_peaks)
+
+    if plot: plot(1e9*ideal_peaks, misalignment, \
+                  title = "Radial speed @ "+wtest_string+" nm",\
+                  ylabel = "Error in speed[m/s]", xlabel = "Wavelength [nm]")
+
+    #Taking the center 3 misalignment points and averaging them
+    return np.mean(median_span(misalignment,1,1))
+
+#Keeps every finished (config, wavelength) cell on disk the moment it is done,
+#one json line per cell, so a crashed or killed sweep resumes from the missing
+#cells only. Every line carries the parameters it was computed with, lines
+#from other parameters(etalon_spacing, virtual_steps, F...) are ignored but kept
+class CheckpointStore:
+
+    def __init__(self, path, parameters = default_parameters):
+        self.path = path
+        #json turns tuples into lists etc, compare against the round-tripped version
+        self.parameters = json.loads(json.dumps(dict(parameters)))
+        self.cells = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue #a line cut short by a crash
+                    if record.get('parameters') == self.parameters:
+                        self.cells[(record['config'], record['wavelength'])] = record['misalignment']
+                #the next record must not be glued onto a cut short line
+                f.seek(0, os.SEEK_END)
+                if f.tell() > 0:
+                    f.seek(f.tell() - 1)
+                    if f.read(1) != '\n':
+                        with open(path, 'a') as g:
+                            g.write('\n')
+
+    #config and wavelength are numbered from 1, as in the zemax C*_W* files
+    def record(self, config, wavelength, misalignment):
+        self.cells[(config, wavelength)] = float(misalignment)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({'config': config, 'wavelength': wavelength, \
+                                'misalignment': float(misalignment), \
+                                'parameters': self.parameters}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def __contains__(self, cell):
+        return cell in self.cells
+
+    #same layout as laser_matrix.txt/misalignment_matrix.txt, missing cells are 0
+    def matrix(self, n_configurations, n_wavelengths):
+        misalignment_container = np.zeros((n_configurations, n_wavelengths))
+        for (config, wavelength), misalignment in self.cells.items():
+            if config <= n_configurations and wavelength <= n_wavelengths:
+                misalignment_container[config - 1][wavelength - 1] = misalignment
+        return misalignment_container
+
+    def export(self, path, n_configurations, n_wavelengths):
+        np.savetxt(path, self.matrix(n_configurations, n_wavelengths))
+
+#a PSFDataset is sent as is(it pickles without anything loaded), the worker
+#then only loads its own configuration. Plain lists send just the one entry
+def _task_source(ordered_data, i):
+    if isinstance(ordered_data, PSF.PSFDataset):
+        return ordered_data
+    return ordered_data[i][:4]
+
+def _config_task(task, plot = None):
+    i, source, parameters, instrumented = task
+    entry = source[i] if isinstance(source, PSF.PSFDataset) else source
+    misalignment, records = instrumentation.run_task(instrumented, i, config_misalignment, entry, parameters, plot)
+    return i, misalignment, records
+
+#runs config_misalignment over the ordered_data indices in configs and fills a
+#(n_configurations x n_wavelengths) matrix, ordered_data can be a list or a
+#psf_analyzer.PSFDataset, cells not in configs stay 0.
+#n_workers > 1 spreads the configurations over a process pool, the matrix
+#is filled by index so the result does not depend on the completion order.
+#With a CheckpointStore the cells already in it are not recomputed and every
+#new cell is written to it as soon as it finishes
+def sweep(ordered_data, n_configurations, n_wavelengths, parameters = default_parameters, \
+          configs = None, n_workers = 1, plot = None, checkpoint = None):
+    if configs is None:
+        configs = range(n_configurations*n_wavelengths)
+    if n_workers < 1:
+        raise Warning('invalid n_workers in sweep')
+
+    def _cell(i):
+        return i//n_wavelengths + 1, i%n_wavelengths + 1
+
+    misalignment_container = np.zeros((n_configurations, n_wavelengths))
+    todo = []
+    for i in configs:
+        if checkpoint is not None and _cell(i) in checkpoint:
+            misalignment_container[i//n_wavelengths][i%n_wavelengths] = checkpoint.cells[_cell(i)]
+        else:
+            todo.append(i)
+    if checkpoint is not None and len(todo) < len(configs):
+        print('Resuming, '+str(len(configs) - len(todo))+' of '+str(len(configs))+' cells already in '+checkpoint.path)
+
+    #a cold PSF cache is built here once, the workers then only map it
+    if n_workers > 1 and todo and isinstance(ordered_data, PSF.PSFDataset) and ordered_data.use_cache:
+        psf_cache.load_psf_stack(ordered_data.rootpath)
+
+    #only what the worker needs is sent over, not the whole ordered_data
+    tasks = [(i, _task_source(ordered_data, i), parameters, instrumentation.settings()) for i in todo]
+
+    #the plots are only drawn by a serial sweep
+    task = _config_task if n_workers > 1 else functools.partial(_config_task, plot = plot)
+    results = task_pool.run_tasks(task, tasks, n_workers)
+    try:
+        for i, focused_average_misalignment, records in tqdm(results, total = len(tasks)):
+            instrumentation.merge(records)
+            misalignment_container[i//n_wavelengths][i%n_wavelengths] = focused_average_misalignment
+            if checkpoint is not None:
+                checkpoint.record(*_cell(i), focused_average_misalignment)
+    finally:
+        results.close()
+
+    return misalignment_container
@@ -6,230 +6,257 @@ Created on Mon May 31 08:45:25 2021
 """
 
 import numpy as np
-import matplotlib.pyplot as plt
+import operator
 import os
+import sys
 
-do_i_plot = True
-#PSF plots raw
-n_w = 9
-n_c = 12
-rootpath = os.path.dirname(__file__) +'/zemax_psf/'
-
-w_range = [i+1 for i in range(n_w)]
-lst = []
-
-for j in range(n_c):
-    for i in range(n_w):
-        lst.append(rootpath+'C'+str(j+1)+'_W'+str(i+1)+'.txt')
-    
-del i
-del w_range
-del rootpath
-
-#quick inspection
-if do_i_plot:
-    plt.figure(figsize = (18,6))
-    plt.title('Fibre PSFs for Order 1')
-for i,f in enumerate(lst):
-    data = np.loadtxt(f,skiprows=17)
-    if do_i_plot and (i in [5,6,7,8]):
-        plt.subplot(1,n_w-5,1+i-5)
-        plt.imshow(data,extent = [-100,100,-100,100])
-        plt.title('Wavelength '+str(i+1))
-    if i == 8:
-        break
-if do_i_plot:    
-    plt.tight_layout()
-
-#first row of psfs
-psf_all = []
-for i,f in enumerate(lst):
-    data = np.loadtxt(f,skiprows=17)
-    psf_all.append(data)
-        
-
-
-    
-#del n_w
-#del n_c
-del i
-del j
-del f 
-del data
-del lst
-#plt.close('all')
-#%%Dispersion plots
-rootpath = rootpath = os.path.dirname(__file__)+'/zemax_psf/RayTrace_Iterate.txt'
-data = np.loadtxt(rootpath, skiprows = 9)
-orders = [((i)*n_w) for i in range(n_c)]
-#data format:
-#ORDER---WAVELENGTH(um)---XPOS(mm)---YPOS(mm)
-
-order = orders[0]
-y = data[order:order+9, 1]
-x = data[order:order+9, 2]
-
-#8th degree polynomial creates the required accuracy
-#test plot
-if do_i_plot:
-    plt.figure()
-    plt.grid('on')
-    plt.plot(x,y, '-*')
-
-
-
-n_p = []
-for i in range(n_c):
-    order = orders[i]
-    x = data[order:order+n_w, 2]
-    y = data[order:order+n_w, 1]
-    p = np.polyfit(x, y, 8)
-    n_p.append(p)
+import psf_cache
+import zemax_io
+from dispersion import DispersionModel
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'filter-analysis'))
+import instrumentation
+import OpticalSystems as opsys
+
+#decimated lines and the headless mode of OpticalSystems(OPSYS_HEADLESS)
+plt = opsys.pyplot
+
+raytrace_file = os.path.join(psf_cache.zemax_folder, 'RayTrace_Iterate.txt')
+
+#%%Kernel generation & centroid calculation, for one PSF or a whole stack.
+#The last two axes are always (y, x), any axes in front of them are batched
+def collapse_psf(psf):
+    return np.sum(psf, axis=-2)
+
+def pixel_centroid(psf_x_collapsed):
+    pixels = np.arange(psf_x_collapsed.shape[-1])
+    return (psf_x_collapsed @ pixels)/psf_x_collapsed.sum(axis=-1)
+
+#(n_c, n_w, y, x) stack -> collapsed kernels, pixel centroids, wavelength axes [um]
+#and wavelength centroids [um], all indexed [order-1, wavelength-1].
+#dispersion is the DispersionModel of the orders, x_offsets the ray-traced x
+#positions(n_c, n_w) [mm] and px the pixel size [mm]. Axis 0 of the stack is
+#order 1, 2... unless orders says otherwise
+@instrumentation.stage
+def batch_kernels(psf_stack, dispersion, x_offsets, px, orders = None):
+    intensity = collapse_psf(psf_stack)
+    centroid = pixel_centroid(intensity)
+    n_pixels = intensity.shape[-1]
+
+    #de-meaned pixel positions, converted into mm and moved to the ray-traced
+    #x coordinate, the dispersion law then turns them into wavelengths
+    x = np.arange(1, n_pixels+1) - centroid[..., None]
+    x = x * px
+    x += x_offsets[..., None]
+    if orders is None:
+        orders = np.arange(1, x.shape[0] + 1)
+    wavelength = dispersion(x, np.asarray(orders)[:, None, None])
+
+    centroid_w = np.sum(intensity*wavelength, axis=-1)/intensity.sum(axis=-1)
+    return intensity, centroid, wavelength, centroid_w
+
+#the ordered_data entry of a batch_kernels result:
+#[order, centroid wavelength, wavelength axis, collapsed kernel],
+#in m, with the kernel scaled to a peak of 1
+def _entry(order, intensity, wavelength, centroid_w):
+    return [order, centroid_w*1e-6, wavelength*1e-6, intensity/max(intensity)]
+
+#a single psf -> its ordered_data entry. dispersion is the DispersionModel,
+#x_offset the ray-traced x position [mm] and px the pixel size [mm], from the
+#"Image Width"/"Number of pixels" header
+def kernel_entry(psf, dispersion, x_offset, order, px):
+    intensity, _, wavelength, centroid_w = batch_kernels(psf[None, None], dispersion,\
+                                                         np.array([[x_offset]]), px, [order])
+    return _entry(order, intensity[0, 0], wavelength[0, 0], centroid_w[0, 0])
+
+#The zemax PSFs as a dataset: nothing is loaded until a kernel is asked for,
+#and then only its PSF is read(from the memory-mapped stack); the first kernel
+#also fits the dispersion laws of every order at once(DispersionModel.from_raytrace),
+#they are kept for the rest. The grid comes from the C*_W*.txt files.
+#dataset[i] is ordered_data[i], i = (order-1)*n_w + (wavelength-1)
+class PSFDataset:
+
+    def __init__(self, rootpath = psf_cache.zemax_folder, raytrace = None, use_cache = True):
+        self.rootpath = rootpath
+        self.raytrace = os.path.join(rootpath, 'RayTrace_Iterate.txt') if raytrace is None else raytrace
+        self.use_cache = use_cache
+        self.files, self.n_c, self.n_w = psf_cache.discover_psf_files(rootpath)
+        self._reset()
+
+    def _reset(self):
+        self._stack = None
+        self._px = None
+        self._raytrace_data = None
+        self._dispersion = None
+        self._kernels = {}
+        self._kernel_arrays = None
+
+    #workers get a fresh, empty dataset(memmaps would otherwise be copied)
+    def __getstate__(self):
+        return {'rootpath': self.rootpath, 'raytrace': self.raytrace, 'use_cache': self.use_cache,\
+                'files': self.files, 'n_c': self.n_c, 'n_w': self.n_w}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
+
+    def __len__(self):
+        return self.n_c*self.n_w
+
+    #indexed like the ordered_data list: negative indices count from the end and
+    #a slice gives a list of entries
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = operator.index(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('PSFDataset index out of range')
+        return self.kernel(i//self.n_w + 1, i%self.n_w + 1)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def _load_stack(self):
+        if self._stack is None:
+            self._stack, index = psf_cache.load_psf_stack(self.rootpath)
+            self._px = index['pixel_size_mm']
+        return self._stack
+
+    def psf(self, order, wavelength):
+        if self.use_cache:
+            return self._load_stack()[order-1, wavelength-1]
+        return zemax_io.read_histogram(self.files[(order, wavelength)])[0]
+
+    #mm per pixel, as written in the zemax headers
+    @property
+    def px(self):
+        if self._px is None:
+            if self.use_cache:
+                self._load_stack()
+            else:
+                self._px = zemax_io.read_histogram(self.files[(1, 1)])[1].pixel_size_mm
+        return self._px
+
+    #data format:
+    #ORDER---WAVELENGTH(um)---XPOS(mm)---YPOS(mm)
+    def raytrace_rows(self, order):
+        if self._raytrace_data is None:
+            self._raytrace_data, _ = zemax_io.read_raytrace(self.raytrace)
+        return self._raytrace_data[self._raytrace_data[:, 0] == order]
+
+    #8th degree law creates the required accuracy, fitted for all orders at once
+    @property
+    def dispersion(self):
+        if self._dispersion is None:
+            self.raytrace_rows(1)
+            self._dispersion = DispersionModel.from_raytrace(self._raytrace_data, 8)
+        return self._dispersion
+
+    def kernel(self, order, wavelength):
+        if (order, wavelength) not in self._kernels:
+            if (order, wavelength) not in self.files:
+                raise Warning('no PSF for order '+str(order)+', wavelength '+str(wavelength))
+            x_offset = self.raytrace_rows(order)[wavelength-1][2]
+            self._kernels[(order, wavelength)] = kernel_entry(self.psf(order, wavelength),\
+                                                              self.dispersion, x_offset, order, self.px)
+        return self._kernels[(order, wavelength)]
+
+    #batch_kernels over the whole grid in one pass, -> (collapsed kernels,
+    #pixel centroids, wavelength axes [um], wavelength centroids [um])
+    @instrumentation.stage
+    def kernel_arrays(self):
+        if self._kernel_arrays is None:
+            if self.use_cache:
+                stack = self._load_stack()
+            else:
+                stack = np.array([[self.psf(j+1, i+1) for i in range(self.n_w)] for j in range(self.n_c)])
+            x_offsets = np.array([self.raytrace_rows(j+1)[:self.n_w, 2] for j in range(self.n_c)])
+            self._kernel_arrays = batch_kernels(stack, self.dispersion, x_offsets, self.px)
+        return self._kernel_arrays
+
+    #the whole grid, in the old ordered_data layout
+    @property
+    def ordered_data(self):
+        intensity, _, wavelength, centroid_w = self.kernel_arrays()
+        for j in range(self.n_c):
+            for i in range(self.n_w):
+                if (j+1, i+1) not in self._kernels:
+                    self._kernels[(j+1, i+1)] = _entry(j+1, intensity[j, i], wavelength[j, i], centroid_w[j, i])
+        return [self[i] for i in range(len(self))]
+
+#%%module level access, kept so that PSF.ordered_data/PSF.n_w/PSF.n_c still work.
+#Importing this module does nothing, the default dataset is made on first use
+_default_dataset = None
+
+def default_dataset():
+    global _default_dataset
+    if _default_dataset is None:
+        _default_dataset = PSFDataset()
+    return _default_dataset
+
+def __getattr__(name):
+    if name == 'ordered_data':
+        return default_dataset().ordered_data
+    if name in ['n_w', 'n_c']:
+        return getattr(default_dataset(), name)
+    raise AttributeError("module 'psf_analyzer' has no attribute '"+name+"'")
+
+#%%the inspection plots, only when run as a script
+if __name__ == '__main__':
+    do_i_plot = True
+
+    dataset = default_dataset()
+    n_w, n_c = dataset.n_w, dataset.n_c
+
+    #quick inspection
     if do_i_plot:
-        plt.figure()
-        plt.plot(x,y, '*', label  = 'Ray-Traced data')
-    yp = np.polyval(n_p[i], x)
-#    print(min(x), max(x))
+        plt.figure(figsize = (18,6))
+        plt.title('Fibre PSFs for Order 1')
+        for i in range(5, n_w):
+            plt.subplot(1,n_w-5,1+i-5)
+            plt.imshow(dataset.psf(1, i+1),extent = [-100,100,-100,100])
+            plt.title('Wavelength '+str(i+1))
+        plt.tight_layout()
+
+    #%%Dispersion plots
+    rows = dataset.raytrace_rows(1)
     if do_i_plot:
-        #plt.plot(x,yp,'-*')
-        pass
-    x = np.linspace(min(x), max(x), 100)#just to check interpolation isnt going insane
-    yp = np.polyval(n_p[i], x)
+        plt.figure()
+        plt.grid('on')
+        plt.plot(rows[:, 2],rows[:, 1], '-*')
+
+    for i in range(n_c):
+        rows = dataset.raytrace_rows(i+1)
+        x = rows[:, 2]
+        y = rows[:, 1]
+        if do_i_plot:
+            plt.figure()
+            plt.plot(x,y, '*', label  = 'Ray-Traced data')
+            x = np.linspace(min(x), max(x), 100)#just to check interpolation isnt going insane
+            yp = dataset.dispersion(x, i+1)
+            plt.plot(x,yp, label = '8^th degree interpolation')
+            plt.legend()
+            plt.title('Ray-Traced and Interpolated dispersion law for order '+str(i+1))
+            plt.xlabel('Position x on detector [mm]')
+            plt.ylabel('Wavelength [nm]')
+            plt.grid('on')
+
+    #%%just to see whats happening
+    ordered_data = dataset.ordered_data
     if do_i_plot:
-        plt.plot(x,yp, label = '8^th degree interpolation')
-        plt.legend()
-        plt.title('Ray-Traced and Interpolated dispersion law for order '+str(i+1))
-        plt.xlabel('Position x on detector [mm]')
-        plt.ylabel('Wavelength [nm]')
+        plt.figure()
+        plt.plot(collapse_psf(dataset.psf(n_c, n_w)))
         plt.grid('on')
+        plt.xlabel('Pixel Position x')
+        plt.ylabel('Relative luminal intensity')
+        plt.title('Kernel for order '+str(n_c)+', wavelength '+str(n_w))
 
-del rootpath
-#del data
-del i
-del order
-del orders
-del p
-del x
-del y
-del yp
-#plt.close('all')
-
-#%%Kernel generation & centroid calculation
-psf_x_collapsed = []
-for i in range(n_c*n_w):
-    psf_x_collapsed.append(np.sum(psf_all[i], axis=0))
-    
-psf_x_centroids = []
-for i in range(n_c*n_w):
-    weightedx = 0
-    for j in range(len(psf_x_collapsed[i])):
-        weightedx = weightedx + j*psf_x_collapsed[i][j]
-    psf_x_centroids.append(weightedx/(psf_x_collapsed[i].sum()))
-    
-del i
-del j
-del weightedx
-#♣just to see whats happening
-x = [i for i in range(100)]
-y = psf_x_collapsed[107]
-
-#test plot
-if do_i_plot:
-    
-    plt.figure()
-    plt.plot(x,y)
-    plt.grid('on')
-    plt.xlabel('Pixel Position x')
-    plt.ylabel('Relative luminal intensity')
-    plt.title('Kernel for order 12, wavelength 9')
-del x
-del y
-#plt.close('all')
-
-#%%adjusting the kernels(centering them), and inputting them into the correct coordinates
-
-#mm per pixel
-px = 0.3/100
-psf_x_centroids_mm = psf_x_centroids
-for i in range(n_w*n_c):
-    psf_x_centroids_mm[i] = np.arange(1- psf_x_centroids[i],101- psf_x_centroids[i],1)
-    psf_x_centroids_mm[i] = psf_x_centroids_mm[i] * px
-    psf_x_centroids_mm[i] += data[i][2]
-    
-#psf_x_centroids_mm is the de-meaned version of psf_x_centroids where each element is an array, and all converted into mm
-#we use this with the diespersion law to turn these mm length into nm wavelengths(since thats what wwe need for the kernel)
-#therefore, we add the offset from the original data(x) to find the correct x coordinate
-psf_w_collapsed = []
-
-for i in range(n_c):
-    p = n_p[i]
-    
-    for j in range(n_w):
-        x = psf_x_centroids_mm[i*9+j]
-        yp = np.polyval(p,x)       
-        psf_w_collapsed.append(yp)
-del i
-del j
-del p
-del x
-del yp
-
-#test plot
-if do_i_plot:
-    plt.figure()
-    plt.plot(psf_w_collapsed[-1]*(1e3), psf_x_collapsed[-1])
-    plt.grid('on')
-    plt.xlabel('Wavelength [nm]')
-    plt.ylabel('Relative luminal intensity')
-    plt.title('Kernel for order 12, wavelength 9')
-
-#%%Formatting the data to use it in other modules
-ordered_data = []
-
-for i in range(n_c):
-    for j in range(n_w):
-        
-        wavelength = psf_w_collapsed[i*9+j]
-        intensity =  psf_x_collapsed[i*9+j]
-        
-        weightedx = 0
-        for k in range(100):
-            weightedx = weightedx + intensity[k]*wavelength[k]
-            
-        centroid_w = weightedx/(intensity.sum())
-        
-        ordered_data.append([i+1, centroid_w , wavelength, intensity])
-        #                       data[i*9+j][1]
-        #•print(centroid_w, data[i*9+j][1])
-
-
-
-del i
-del j
-del k
-del weightedx
-del centroid_w
-
-#%%clean up useless data when this module is exported
-del data
-del do_i_plot
-del intensity
-#del n_c
-del n_p
-#del n_w
-del px
-del wavelength
-del psf_all
-del psf_w_collapsed
-del psf_x_collapsed
-del psf_x_centroids
-del psf_x_centroids_mm
-
-#%% convert to m and adjusting colapsed psf to 1
-for count, case in enumerate(ordered_data):
-    ordered_data[count][1] *= 1e-6#convert micrometers to meters 
-    ordered_data[count][2] *= 1e-6#convert micrometers to meters 
-    ordered_data[count][3] /= max( ordered_data[count][3])#scaling the gaussians to a peak value of 1
-
-del count
-del case
+        plt.figure()
+        plt.plot(ordered_data[-1][2]*(1e9), ordered_data[-1][3])
+        plt.grid('on')
+        plt.xlabel('Wavelength [nm]')
+        plt.ylabel('Relative luminal intensity')
+        plt.title('Kernel for order '+str(n_c)+', wavelength '+str(n_w))
+        plt.show()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+One time conversion of the zemax_psf/C*_W*.txt histograms into a single
+binary (n_c, n_w, pixels, pixels) stack that is memory-mapped on load.
+
+@author: User
+"""
+import numpy as np
+import json
+import os
+import re
+import sys
+
+import zemax_io
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'filter-analysis'))
+import instrumentation
+
+zemax_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'zemax_psf')
+
+stack_name = 'psf_stack.npy'
+index_name = 'psf_stack_index.json'
+
+#C<config>_W<wavelength>.txt -> the grid is whatever is in the folder
+def discover_psf_files(rootpath = zemax_folder):
+    files = {}
+    for name in os.listdir(rootpath):
+        match = re.fullmatch(r'C(\d+)_W(\d+)\.txt', name)
+        if match:
+            files[(int(match.group(1)), int(match.group(2)))] = os.path.join(rootpath, name)
+    if not files:
+        raise Warning('no C*_W*.txt files in '+rootpath)
+    n_c = max(k[0] for k in files)
+    n_w = max(k[1] for k in files)
+    if len(files) != n_c*n_w:
+        raise Warning('incomplete C*_W* grid in '+rootpath)
+    return files, n_c, n_w
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+#written next to its final name(unique to the process) and renamed when
+#complete, a half written file is never picked up. Processes building the same
+#cache at once each rename a complete copy; where the rename fails(windows,
+#the file is mapped by another process) the copy already there is kept
+def _publish(temporary, path):
+    try:
+        os.replace(temporary, path)
+    except OSError:
+        os.remove(temporary)
+        if not os.path.exists(path):
+            raise
+
+#parses every text file once and writes the stack plus a sidecar index
+#(grid size, dtype, shape, the pixel geometry from the zemax headers and the
+#size/mtime of every source file)
+@instrumentation.stage
+def build_psf_cache(rootpath = zemax_folder, cache_folder = None):
+    cache_folder = rootpath if cache_folder is None else cache_folder
+    files, n_c, n_w = discover_psf_files(rootpath)
+    suffix = '.' + str(os.getpid()) + '.tmp'
+
+    first, first_header = zemax_io.read_histogram(files[(1, 1)])
+    stack = np.lib.format.open_memmap(os.path.join(cache_folder, stack_name + suffix), mode = 'w+',\
+                                      dtype = np.float64, shape = (n_c, n_w) + first.shape)
+    for (j, i), path in files.items():
+        data, header = (first, first_header) if (j, i) == (1, 1) else zemax_io.read_histogram(path)
+        if data.shape != first.shape or header.image_width_mm != first_header.image_width_mm:
+            raise Warning('pixel grid of '+path+' differs from C1_W1')
+        stack[j-1, i-1] = data
+    stack.flush()
+    del stack
+    _publish(os.path.join(cache_folder, stack_name + suffix), os.path.join(cache_folder, stack_name))
+
+    index = {'n_c': n_c, 'n_w': n_w, 'shape': [n_c, n_w] + list(first.shape), 'dtype': 'float64',\
+             'image_width_mm': first_header.image_width_mm, 'pixels': list(first_header.pixels),\
+             'pixel_size_mm': first_header.pixel_size_mm,\
+             'files': {os.path.basename(path): _file_signature(path) for path in files.values()}}
+    with open(os.path.join(cache_folder, index_name + suffix), 'w') as f:
+        json.dump(index, f, indent = 1)
+    _publish(os.path.join(cache_folder, index_name + suffix), os.path.join(cache_folder, index_name))
+    return index
+
+#-> (stack, index), stack is a read only memmap indexed [config-1, wavelength-1].
+#The cache is (re)built when it is missing or any source file changed
+@instrumentation.stage
+def load_psf_stack(rootpath = zemax_folder, cache_folder = None, rebuild = False):
+    cache_folder = rootpath if cache_folder is None else cache_folder
+    stack_path = os.path.join(cache_folder, stack_name)
+    index_path = os.path.join(cache_folder, index_name)
+
+    index = None
+    if not rebuild and os.path.exists(stack_path) and os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        files, _, _ = discover_psf_files(rootpath)
+        current = {os.path.basename(path): _file_signature(path) for path in files.values()}
+        #indexes from before the pixel geometry was stored are rebuilt too
+        if current != index['files'] or 'pixel_size_mm' not in index:
+            index = None
+    if index is None:
+        print('Building binary PSF cache in '+cache_folder)
+        index = build_psf_cache(rootpath, cache_folder)
+
+    stack = np.load(stack_path, mmap_mode = 'r')
+    if list(stack.shape) != index['shape']:
+        raise Warning('PSF cache does not match its index, rebuild it')
+    return stack, index
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Readers for the Zemax text exports in zemax_psf: the image analysis
+histograms(C*_W*.txt) and the RAYTRACE_ITERATE.ZPL output.
+
+@author: User
+"""
+import numpy as np
+import re
+from dataclasses import dataclass
+
+#everything zemax writes above the histogram
+@dataclass
+class HistogramHeader:
+    path: str
+    zemax_file: str
+    title: str
+    date: str
+    configuration: int
+    n_configurations: int
+    field_width_mm: float
+    image_width_mm: float
+    pixels: tuple #(x, y) as in "Number of pixels : 100 x 100"
+    rays_attempted: float
+    rays_passed: float
+    rays_launched: int
+    efficiency_percent: float
+    total_flux_w: float
+    units: str
+
+    #mm per pixel, what used to be hard-coded as 0.3/100
+    @property
+    def pixel_size_mm(self):
+        return self.image_width_mm/self.pixels[0]
+
+@dataclass
+class RayTraceHeader:
+    path: str
+    surface: int
+    field: int
+    configurations: tuple #(first, last)
+    wavelengths: tuple #(first, last)
+
+def _millimeters(value, key, path):
+    number, unit = value.split()
+    if unit != 'Millimeters':
+        raise Warning(key+' of '+path+' is not in Millimeters')
+    return float(number)
+
+def _parse_histogram_header(lines, path):
+    fields = {}
+    configuration = None
+    for line in lines:
+        match = re.match(r'\s*Configuration\s+(\d+)\s+of\s+(\d+)', line)
+        if match:
+            configuration = (int(match.group(1)), int(match.group(2)))
+        elif ':' in line:
+            key, value = line.split(':', 1)
+            fields[key.strip()] = value.strip()
+    try:
+        pixels = tuple(int(v) for v in fields['Number of pixels'].split('x'))
+        return HistogramHeader(path = path,
+                               zemax_file = fields.get('File', ''),
+                               title = fields.get('Title', ''),
+                               date = fields.get('Date', ''),
+                               configuration = configuration[0],
+                               n_configurations = configuration[1],
+                               field_width_mm = _millimeters(fields['Field Width'], 'Field Width', path),
+                               image_width_mm = _millimeters(fields['Image Width'], 'Image Width', path),
+                               pixels = pixels,
+                               rays_attempted = float(fields['Total Weight of Rays Attempted']),
+                               rays_passed = float(fields['Total Weight of Rays Passed']),
+                               rays_launched = int(fields['Total Rays Launched']),
+                               efficiency_percent = float(fields['Percent Efficiency'].rstrip('%')),
+                               total_flux_w = float(fields['Total flux in watts']),
+                               units = fields.get('Units', ''))
+    except (KeyError, TypeError, ValueError):
+        raise Warning('unexpected histogram header in '+path)
+
+#exact powers of ten, a single multiply/divide by them is correctly rounded
+_powers_of_ten = np.array([float(10**k) for k in range(23)])
+
+#Zemax writes every value as %12.4E followed by a tab or newline, so the
+#block is a (values x 13) byte matrix that can be decoded column-wise.
+#Returns None when the block does not have that layout
+def _parse_fixed_width(body, n_values):
+    width = 13
+    raw = np.frombuffer(body.rstrip(), dtype = np.uint8)
+    if raw.size != n_values*width - 1:
+        return None
+    cells = np.empty(n_values*width, dtype = np.uint8)
+    cells[:-1] = raw
+    cells[-1] = ord('\n')
+    cells = cells.reshape(n_values, width)
+
+    #digits and the exponent are decoded in place, '0'..'9' -> 0..9
+    digits = cells[:, [2, 4, 5, 6, 7, 10, 11]] - np.uint8(ord('0'))
+    sign = cells[:, 1]
+    exponent_sign = cells[:, 9]
+    separator = cells[:, 12]
+    layout = (digits <= 9).all() and (cells[:, 0] == ord(' ')).all() \
+        and (cells[:, 3] == ord('.')).all() and (cells[:, 8] == ord('E')).all() \
+        and ((sign == ord(' ')) | (sign == ord('-'))).all() \
+        and ((exponent_sign == ord('+')) | (exponent_sign == ord('-'))).all() \
+        and ((separator == ord('\t')) | (separator == ord('\n'))).all()
+    if not layout:
+        return None
+
+    digits = digits.astype(np.int32)
+    mantissa = (((digits[:, 0]*10 + digits[:, 1])*10 + digits[:, 2])*10 + digits[:, 3])*10 + digits[:, 4]
+    exponent = digits[:, 5]*10 + digits[:, 6]
+    exponent = np.where(exponent_sign == ord('-'), -exponent, exponent) - 4
+    exact = np.abs(exponent) < len(_powers_of_ten)
+    power = _powers_of_ten[np.minimum(np.abs(exponent), len(_powers_of_ten) - 1)]
+    values = np.where(exponent >= 0, mantissa*power, mantissa/power)
+    #tiny/huge exponents are left to python's own float parsing
+    for k in np.flatnonzero(~exact):
+        values[k] = float(cells[k, :12].tobytes())
+    values[sign == ord('-')] *= -1
+    return values
+
+#-> (histogram, header). The pixel grid is checked against the header
+def read_histogram(path):
+    with open(path, 'rb') as f:
+        content = f.read()
+
+    #the header stops at the first line that starts with a number
+    lines = content.split(b'\n', 64)[:-1]
+    for n_header, line in enumerate(lines):
+        stripped = line.strip()
+        if stripped and (stripped[:1].isdigit() or stripped[:1] == b'-'):
+            break
+    else:
+        raise Warning('no histogram in '+path)
+    header = _parse_histogram_header([l.decode('latin-1') for l in lines[:n_header]], path)
+    nx, ny = header.pixels
+
+    body = content[sum(len(l) + 1 for l in lines[:n_header]):]
+    values = _parse_fixed_width(body, nx*ny)
+    if values is None:
+        values = np.loadtxt(path, skiprows = n_header).ravel()
+    if values.size != nx*ny:
+        raise Warning('pixel grid of '+path+' does not match its '+str(nx)+' x '+str(ny)+' header')
+    return values.reshape(ny, nx), header
+
+#-> (rows, header), rows are ORDER---WAVELENGTH(um)---XPOS(mm)---YPOS(mm)
+def read_raytrace(path):
+    with open(path, 'r', encoding = 'latin-1') as f:
+        content = f.read()
+
+    surface = re.search(r'surface\(number\s+(\d+)\)', content)
+    field = re.search(r'field number\s+(\d+)', content)
+    iterates = re.search(r'configurations\s+(\d+)\s+to\s+(\d+),\s*and wavelength numbers\s+(\d+)\s+to\s+(\d+)', content)
+    if not (surface and field and iterates):
+        raise Warning('unexpected ray trace header in '+path)
+    header = RayTraceHeader(path = path, surface = int(surface.group(1)), field = int(field.group(1)),
+                            configurations = (int(iterates.group(1)), int(iterates.group(2))),
+                            wavelengths = (int(iterates.group(3)), int(iterates.group(4))))
+
+    #the rows are everything after the column titles
+    body = content[content.index('position y(mm)') + len('position y(mm)'):]
+    rows = np.array(body.split(), dtype = float)
+    if rows.size % 4 != 0:
+        raise Warning('ray trace rows of '+path+' are not 4 columns wide')
+    rows = rows.reshape(-1, 4)
+
+    n_c = header.configurations[1] - header.configurations[0] + 1
+    n_w = header.wavelengths[1] - header.wavelengths[0] + 1
+    if len(rows) != n_c*n_w:
+        raise Warning(path+' has '+str(len(rows))+' rows, the header announces '+str(n_c*n_w))
+    return rows, header